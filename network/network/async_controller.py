@@ -0,0 +1,175 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from network.common.aio import LoopThread, LoopConnection
+from network.common.data import DataNode
+from network.common.framing import FrameDecoder, FRAME_JSON, FRAME_PING, load_json
+from network.common.networkk import Network
+from network.common.utils import debug_log, debug_warning, debug_exception
+from network.controller import Controller, BUFFER_SIZE, HEARTBEAT_TIMEOUT, HEARTBEAT_MISSES, HEARTBEAT_CHECK_MAX, \
+    TOPOLOGY_WINDOW, TOPOLOGY_MAX_DELAY, ROUTE_SENDERS
+
+
+class AsyncController(Controller):
+    """
+    Controller with handshakes, heartbeats and route pushes running concurrently on one asyncio
+    event loop instead of a blocking accept loop and one thread per router.
+
+    Every handshake has its own timeout, so a stalled router cannot hold up the others while they
+    join. Route pushes are written without waiting for the receiving router, and a router that does
+    not take its data within write_timeout is disconnected. Route computation only runs on the topology
+    scheduler thread, so it never blocks the loop.
+    """
+
+    def __init__(self,
+                 host: str,
+                 port: int,
+                 network: Network,
+                 workers: Optional[int] = None,
+                 handshake_timeout: float = 5.0,
+                 write_timeout: float = 10.0,
+                 heartbeat_timeout: float = HEARTBEAT_TIMEOUT,
+                 heartbeat_misses: int = HEARTBEAT_MISSES,
+                 topology_window: float = TOPOLOGY_WINDOW,
+                 topology_max_delay: float = TOPOLOGY_MAX_DELAY,
+                 route_senders: int = ROUTE_SENDERS
+                 ) -> None:
+        super().__init__(host, port, network, heartbeat_timeout, heartbeat_misses,
+                         topology_window, topology_max_delay, route_senders)
+
+        # Timeouts per connection
+        self.handshake_timeout: float = handshake_timeout
+        self.write_timeout: float = write_timeout
+
+        # Executor for the blocking work of a connection, like closing it
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=self.NAME)
+
+        # Event loop and server
+        self.loop_thread: LoopThread = LoopThread(self.NAME)
+        self.loop: asyncio.AbstractEventLoop = self.loop_thread.loop
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    def start_server(self) -> None:
+        try:
+            self.server = self.loop_thread.run(self._start_server())
+            threading.Thread(target=self.apply_topology_changes, name=f"{self.NAME} | Topology").start()
+            debug_log(self.NAME,
+                      f"Controller started.")
+        except Exception as ex:
+            debug_exception(self.NAME,
+                            f"Controller start error: {ex}")
+
+    async def _start_server(self) -> asyncio.AbstractServer:
+        server = await asyncio.start_server(self._accept, self.host, self.port, backlog=1024)
+        self.loop_thread.spawn(self._check_heartbeats())
+        return server
+
+    def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # Tracked as our own task so stop() can cancel it
+        self.loop_thread.spawn(self._handle_connection(reader, writer))
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        address: Tuple[str, int] = writer.get_extra_info("peername")
+        decoder = FrameDecoder(BUFFER_SIZE)
+        try:
+            data_auth: Dict = await asyncio.wait_for(self._read_auth(reader, decoder), self.handshake_timeout)
+            node: DataNode = DataNode.from_json(data_auth)
+        except asyncio.TimeoutError:
+            debug_warning(self.NAME,
+                          f"Handshake with {address} timed out")
+            writer.close()
+            return
+        except Exception as ex:
+            debug_warning(self.NAME,
+                          f"Handshake with {address} failed: {ex}")
+            writer.close()
+            return
+
+        client = LoopConnection(self.loop_thread, writer, self.write_timeout)
+
+        # Its snapshot is computed by the topology scheduler
+        self.register_client(node, client)
+        debug_log(self.NAME,
+                  f"Connection established with {address}")
+
+        try:
+            while self.running.is_set():
+                for frame_type, payload in decoder.frames():
+                    if frame_type == FRAME_PING:
+                        # Measured RTTs are only queued for the topology scheduler
+                        self.process_ping(node, payload)
+                        continue
+                    if frame_type != FRAME_JSON:
+                        continue
+                    message_json: Dict = load_json(payload)
+                    if message_json.get("type") == "ping":
+                        self.process_message(message_json, node)
+                    else:
+                        await self.loop.run_in_executor(self.executor, self.process_message, message_json, node)
+
+                data = await reader.read(BUFFER_SIZE)
+                if not data:
+                    break
+                decoder.feed(data)
+        except Exception as ex:
+            if self.running.is_set():
+                debug_exception(self.NAME,
+                                f"Error handling client {node.name}: {ex}")
+        finally:
+            if self.running.is_set():
+                await self.loop.run_in_executor(self.executor, self.close_client, client, node)
+
+    @staticmethod
+    async def _read_auth(reader: asyncio.StreamReader, decoder: FrameDecoder) -> Dict:
+        # The first message is the router's DataNode; anything after it stays in the decoder
+        while True:
+            for frame_type, payload in decoder.frames():
+                return load_json(payload)
+            data = await reader.read(BUFFER_SIZE)
+            if not data:
+                raise ConnectionError("Connection closed before authentication")
+            decoder.feed(data)
+
+    async def _check_heartbeats(self) -> None:
+        while self.running.is_set():
+            next_deadline: Optional[float] = self.liveness.next_deadline()
+            delay = HEARTBEAT_CHECK_MAX if next_deadline is None else next_deadline - time.time()
+            await asyncio.sleep(min(max(delay, 0.01), HEARTBEAT_CHECK_MAX))
+
+            # Closing recomputes routes, so it runs on the executor
+            for name in self.liveness.expired():
+                debug_warning(self.NAME,
+                              f"Router {name} is considered disconnected.")
+                await self.loop.run_in_executor(self.executor, self.remove_client_by_name, name)
+
+    def stop(self) -> None:
+        if self.loop.is_closed():
+            return
+        self.running.clear()
+        try:
+            self.loop_thread.run(self._shutdown())
+        except Exception as ex:
+            debug_exception(self.NAME,
+                            f"Error stopping the event loop: {ex}")
+
+        self.loop_thread.stop()
+        self.executor.shutdown(wait=False)
+        self.route_senders.shutdown(wait=False)
+        self.server_socket.close()
+        debug_warning(self.NAME,
+                      "Controller Server Stopped.")
+
+    async def _shutdown(self) -> None:
+        if self.server:
+            self.server.close()
+
+        with self.lock:
+            clients = list(self.clients.values())
+            self.clients.clear()
+        for client in clients:
+            client.close()
+
+        await self.loop_thread.cancel_tasks()
@@ -0,0 +1,353 @@
+import asyncio
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, Optional, Tuple, Union
+
+from network.common.aio import LoopThread, LoopConnection, LoopOutbox
+from network.common.data import DataNode
+from network.common.delivery import CLIENT_QUEUE_SIZE, CLIENT_BUFFER_BYTES, DROP
+from network.common.framing import FrameDecoder, FRAME_DATA, FRAME_FORWARD, encode_json, encode_ping, load_json
+from network.common.keys import Identity
+from network.common.pool import COALESCE_BYTES
+from network.common.probe import PROBE_INTERVAL
+from network.common.security import serialize_key_public
+from network.common.utils import debug_log, debug_warning, debug_exception
+from network.common.workers import PROCESS_THRESHOLD, MAX_INFLIGHT_BYTES
+from network.router import Router, BUFFER_SIZE, HEARTBEAT_INTERVAL, FORWARD_TTL
+
+# Frames waiting for each next hop before the threads sending to it are held back
+HOP_QUEUE_SIZE = 64
+
+
+class AsyncRouter(Router):
+    """
+    Router with the same external API, but with accept, read, forward, heartbeat and route listening
+    running as tasks on a single asyncio event loop instead of one thread per connection.
+
+    The loop runs in its own thread, so connect_to_controller, start_server, send_message and stop
+    can still be called from regular code. Decryption, encryption and file writes run on a thread
+    pool executor so they never block the loop.
+    """
+
+    def __init__(self,
+                 controller_host: str,
+                 controller_port: int,
+                 local_host: str,
+                 local_port: int,
+                 name: str = "NONE",
+                 persist_routes: bool = True,
+                 workers: Optional[int] = None,
+                 idle_timeout: float = 60.0,
+                 backoff_initial: float = 0.5,
+                 backoff_max: float = 30.0,
+                 hop_queue_size: int = HOP_QUEUE_SIZE,
+                 key_dir: Optional[str] = None,
+                 identity: Optional[Identity] = None,
+                 coalesce_window: float = 0.0,
+                 coalesce_bytes: int = COALESCE_BYTES,
+                 process_workers: int = 0,
+                 process_threshold: int = PROCESS_THRESHOLD,
+                 max_inflight_bytes: int = MAX_INFLIGHT_BYTES,
+                 client_queue_size: int = CLIENT_QUEUE_SIZE,
+                 client_overflow: str = DROP,
+                 client_buffer_bytes: int = CLIENT_BUFFER_BYTES,
+                 heartbeat_interval: float = HEARTBEAT_INTERVAL,
+                 probe_interval: float = PROBE_INTERVAL,
+                 source_routing: bool = False,
+                 forward_ttl: int = FORWARD_TTL
+                 ) -> None:
+        # Frames already run on the executor below, so the Router's own worker stage stays inline
+        super().__init__(controller_host, controller_port, local_host, local_port, name, persist_routes,
+                         key_dir=key_dir, identity=identity,
+                         coalesce_window=coalesce_window, coalesce_bytes=coalesce_bytes,
+                         process_workers=process_workers, process_threshold=process_threshold,
+                         max_inflight_bytes=max_inflight_bytes,
+                         client_queue_size=client_queue_size, client_overflow=client_overflow,
+                         heartbeat_interval=heartbeat_interval, probe_interval=probe_interval,
+                         source_routing=source_routing, forward_ttl=forward_ttl)
+
+        # Deliveries to local clients wait in their transports, client_queue_size does not apply here
+        self.client_buffer_bytes: int = client_buffer_bytes
+
+        # Executor for CPU heavy work
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=self.NAME)
+
+        # Next hop connections
+        self.idle_timeout: float = idle_timeout
+        self.backoff_initial: float = backoff_initial
+        self.backoff_max: float = backoff_max
+        self.hop_queues: Dict[Tuple[str, int], asyncio.Queue] = {}
+        self.hop_queue_size: int = hop_queue_size
+
+        # Event loop and server; connections are wrapped so the Router code can use them as sockets
+        self.loop_thread: LoopThread = LoopThread(self.NAME)
+        self.loop: asyncio.AbstractEventLoop = self.loop_thread.loop
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    def connect_to_controller(self) -> None:
+        try:
+            self.loop_thread.run(self._connect_to_controller())
+        except Exception as ex:
+            debug_exception(self.NAME,
+                            f"Failed to connect to controller: {ex}")
+
+    async def _connect_to_controller(self) -> None:
+        reader, writer = await asyncio.open_connection(self.controller_host, self.controller_port)
+        self.controller_socket.close()
+        self.controller_socket = LoopConnection(self.loop_thread, writer)
+        debug_log(self.NAME,
+                  f"Connected to the controller {(self.controller_host, self.controller_port)}")
+
+        # Auth the router
+        message_auth = DataNode(
+            name=self.name,
+            ip=self.local_host,
+            port=self.local_port,
+            public_key=serialize_key_public(self.public_key)
+        )
+        writer.write(encode_json(message_auth.__dict__()))
+        await writer.drain()
+
+        self.loop_thread.spawn(self._routes_listener(reader))
+        self.loop_thread.spawn(self._heartbeat())
+
+    async def _heartbeat(self) -> None:
+        while self.running.is_set():
+            try:
+                self.controller_socket.sendall(encode_ping(self.heartbeat_interval, self.prober.take()))
+            except Exception as ex:
+                debug_exception(self.NAME, f"Error sending heartbeat: {ex}")
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def _routes_listener(self, reader: asyncio.StreamReader) -> None:
+        decoder = FrameDecoder(BUFFER_SIZE)
+        try:
+            while self.running.is_set():
+                data = await reader.read(BUFFER_SIZE)
+                if not data:
+                    debug_warning(self.NAME,
+                                  "Connection closed by the controller")
+                    break
+
+                decoder.feed(data)
+                for frame_type, payload in decoder.frames():
+                    try:
+                        # Snapshots can be large and are persisted, keep them off the loop
+                        await self.loop.run_in_executor(self.executor, self._process_routes_payload, payload)
+                    except Exception as ex:
+                        debug_warning(self.NAME, f"Received invalid route update.\nError: {ex}")
+        except Exception as ex:
+            if self.running.is_set():
+                debug_exception(self.NAME, f"Error processing received routes: {ex}")
+
+    def _process_routes_payload(self, payload: Union[bytes, Dict]) -> None:
+        self.process_routes(load_json(payload))
+
+    def start_server(self) -> None:
+        try:
+            self.server = self.loop_thread.run(self._start_server())
+            debug_log(self.NAME,
+                      f"Router Server started.")
+        except Exception as ex:
+            debug_exception(self.NAME,
+                            f"Router Server start error: {ex}")
+
+    async def _start_server(self) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self._accept, self.local_host, self.local_port)
+
+    def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # Tracked as our own task so stop() can cancel it
+        self.loop_thread.spawn(self._handle_connection(reader, writer))
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        address: Tuple[str, int] = writer.get_extra_info("peername")
+        client = LoopConnection(self.loop_thread, writer)
+        with self.lock:
+            self.clients[address] = client
+        debug_log(self.NAME,
+                  f"Accepted connection from {address}")
+
+        decoder = FrameDecoder(BUFFER_SIZE)
+        reserved: int = 0
+        try:
+            while self.running.is_set():
+                if not reserved and decoder.pending_frame() is not None:
+                    # A large payload waits for room under the in-flight bytes cap before it is read
+                    reserved = await self.loop.run_in_executor(self.executor, self.admit_frame, decoder)
+                data = await reader.read(BUFFER_SIZE)
+                if not data:
+                    debug_log(self.NAME,
+                              f"Connection closed by {address}")
+                    break
+
+                decoder.feed(data)
+                for frame_type, payload in decoder.frames():
+                    # Awaiting each frame keeps the per-connection order, other connections go on meanwhile.
+                    # The worker stage runs it inline, only waiting for room under the in-flight bytes cap
+                    size = len(payload) if frame_type in (FRAME_DATA, FRAME_FORWARD) else 0
+                    await self.loop.run_in_executor(
+                        self.executor,
+                        partial(self.workers.submit, self.process_frame, frame_type, payload, client, address,
+                                size=size, reserved=bool(reserved))
+                    )
+                    reserved = 0
+        except Exception as ex:
+            if self.running.is_set():
+                debug_exception(self.NAME,
+                                f"Error Reading Messages: {ex}")
+        finally:
+            self.workers.release(reserved)
+            self.close_client(client, address)
+
+    def open_outbox(self, client: LoopConnection, address: Tuple[str, int]) -> LoopOutbox:
+        return LoopOutbox(self.NAME, client, address, self.close_client, self.client_buffer_bytes,
+                          self.client_overflow)
+
+    def send_frame(self, next_node: DataNode, frame: bytes) -> None:
+        # Called off the loop, and waits while the next hop's queue is full, so a slow or unreachable
+        # neighbour holds back the readers instead of piling up frames
+        if not self.running.is_set():
+            return
+        queued: concurrent.futures.Future = concurrent.futures.Future()
+        self.loop_thread.call_soon(self._enqueue, (next_node.ip, next_node.port), next_node.name, frame, queued)
+        while True:
+            try:
+                queued.result(1.0)
+                return
+            except concurrent.futures.TimeoutError:
+                if not self.running.is_set():
+                    return
+
+    def _enqueue(self, address: Tuple[str, int], name: str, frame: bytes, queued: concurrent.futures.Future) -> None:
+        queue = self.hop_queues.get(address)
+        if queue is None:
+            queue = asyncio.Queue(self.hop_queue_size)
+            self.hop_queues[address] = queue
+            self.loop_thread.spawn(self._next_hop_sender(address, name, queue))
+        if queue.full():
+            self.loop_thread.spawn(self._put(queue, frame, queued))
+            return
+        queue.put_nowait(frame)
+        queued.set_result(None)
+
+    @staticmethod
+    async def _put(queue: asyncio.Queue, frame: bytes, queued: concurrent.futures.Future) -> None:
+        await queue.put(frame)
+        queued.set_result(None)
+
+    async def _next_hop_sender(self, address: Tuple[str, int], name: str, queue: asyncio.Queue) -> None:
+        # One long-lived connection per next hop, fed by its queue and closed after idle_timeout
+        writer: Optional[asyncio.StreamWriter] = None
+        failures = 0
+        try:
+            while self.running.is_set():
+                try:
+                    frame = await asyncio.wait_for(queue.get(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    if queue.empty():
+                        # The queue is dropped in the finally below, unless it was replaced meanwhile
+                        debug_log(self.NAME,
+                                  f"Closing idle connection to {name}")
+                        break
+                    continue
+
+                frame = await self._gather(queue, frame)
+
+                # A connection may have died since its last use, so retry once on a fresh one
+                for attempt in range(2):
+                    try:
+                        if writer is None or writer.is_closing():
+                            writer = await self._open_next_hop(address)
+                        writer.write(frame)
+                        await writer.drain()
+                        failures = 0
+                        debug_log(self.NAME,
+                                  f"Message SENT to {name}: {len(frame)} bytes")
+                        break
+                    except OSError as ex:
+                        if writer is not None:
+                            writer.close()
+                            writer = None
+                        if attempt:
+                            failures += 1
+                            debug_exception(self.NAME,
+                                            f"Failed to send message to {name}: {ex}")
+                            await asyncio.sleep(min(self.backoff_max, self.backoff_initial * 2 ** (failures - 1)))
+        finally:
+            if self.hop_queues.get(address) is queue:
+                del self.hop_queues[address]
+            if writer is not None:
+                writer.close()
+
+    async def _gather(self, queue: asyncio.Queue, frame: bytes) -> bytes:
+        # Frames already queued go out in the same write, and with a coalesce_window
+        # later ones are waited for until the window or the byte budget runs out
+        frames = [frame]
+        size = len(frame)
+        deadline = self.loop.time() + self.pool.coalesce_window
+        while size < self.pool.coalesce_bytes:
+            if queue.empty():
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    frame = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                frame = queue.get_nowait()
+            frames.append(frame)
+            size += len(frame)
+        return frame if len(frames) == 1 else b"".join(frames)
+
+    async def _open_next_hop(self, address: Tuple[str, int]) -> asyncio.StreamWriter:
+        reader, writer = await asyncio.open_connection(*address)
+        writer.write(self.pool.hello)
+        self.loop_thread.spawn(self._watch_next_hop(reader, writer))
+        return writer
+
+    @staticmethod
+    async def _watch_next_hop(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # Neighbours never write on these connections, so EOF means the link went away
+        try:
+            await reader.read()
+        finally:
+            writer.close()
+
+    def stop(self) -> None:
+        if self.loop.is_closed():
+            return
+        self.running.clear()
+        try:
+            self.loop_thread.run(self._shutdown())
+        except Exception as ex:
+            debug_exception(self.NAME,
+                            f"Error stopping the event loop: {ex}")
+
+        self.loop_thread.stop()
+        self.executor.shutdown(wait=False)
+        self.workers.shutdown()
+        self.discard_transfers()
+        if self.route_store is not None:
+            self.route_store.close()
+        self.prober.close()
+        self.server_socket.close()
+        debug_warning(self.NAME,
+                      "Router Server Stopped.")
+
+    async def _shutdown(self) -> None:
+        if self.server:
+            self.server.close()
+
+        with self.lock:
+            for outbox in self.outboxes.values():
+                outbox.close()
+            self.outboxes.clear()
+            connections = [*self.clients.values(), *self.peers.values()]
+            self.clients.clear()
+            self.peers.clear()
+        for connection in [*connections, self.controller_socket]:
+            connection.close()
+
+        await self.loop_thread.cancel_tasks()
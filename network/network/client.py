@@ -1,11 +1,24 @@
-import base64
+import asyncio
+import os
+import queue
 import socket
-import json
+import threading
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
 
-from network.common.data import DataMessage
+from network.common.framing import FrameDecoder, FRAME_JSON, BUFFER_SIZE, encode_data, encode_json, load_json
+from network.common.transfer import CHUNK_SIZE
 
 
 class Client:
+    """
+    Connection from a local client to its router.
+
+    Messages can be sent from any thread, without waiting for each other or for replies. Deliveries from
+    the router are read by a background loop started on connect. They go to the callbacks registered
+    with on_message, to the async iterators from messages(), or otherwise to the inbox read by
+    receive_message.
+    """
+
     def __init__(self,
                  router_host: str,
                  router_port: int
@@ -15,44 +28,161 @@ class Client:
         self.router_port: int = router_port
         self.client: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
+        # Frames from different threads must not interleave
+        self.send_lock = threading.Lock()
+
+        # Deliveries from the router
+        self.inbox: queue.Queue = queue.Queue()
+        self.callbacks: List[Callable[[Dict], None]] = []
+        self.subscribers: List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = []
+        self.receiver: Optional[threading.Thread] = None
+        self.running = threading.Event()
+
     def connect(self) -> None:
         try:
             self.client.connect((self.router_host, self.router_port))
+            self.client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             print(f"Connected to the Router {self.router_host}:{self.router_port}")
+
+            # Tells the router to frame its deliveries to this client
+            self.client.sendall(encode_json({"type": "client"}))
+
+            self.running.set()
+            self.receiver = threading.Thread(target=self.receive_loop, daemon=True)
+            self.receiver.start()
         except Exception as ex:
             print(f"Failed to connect to the router: {ex}")
             if self.client:
                 self.client.close()
 
-    def send_message(self, destination: str, message: str, is_file: bool = False, binary: bytes = bytes()) -> None:
+    def send_message(self, destination: str, message: str, is_file: bool = False, binary: bytes = bytes(),
+                     flow: str = None) -> None:
+        """ Messages with the same flow take the same path, others are spread over the paths to destination. """
         try:
-            if is_file:
-                binary_data_encoded = base64.b64encode(binary).decode('utf-8')
-            else:
-                binary_data_encoded = ""
-
             client_message = {
                 'destination': destination,
                 'message': message,
-                'is_file': is_file,
-                'binary': binary_data_encoded
+                'is_file': is_file
             }
+            if flow:
+                client_message['flow'] = flow
 
-            json_data = json.dumps(client_message)
-            self.client.sendall(json_data.encode('utf-8'))
+            # The file goes raw behind the header
+            self.send_frame(encode_data(client_message, binary if is_file else b""))
             print(f"Message sent to {destination} -> {message}")
         except Exception as ex:
             print(f"Failed to send message: {ex}")
 
-    def receive_message(self):
+    def send_file(self, destination: str, file_path: str, name: str = None, chunk_size: int = CHUNK_SIZE
+                  ) -> Optional[str]:
+        """ Stream a file from disk to destination chunk by chunk, returns its upload id. """
+        name = name or os.path.basename(file_path)
+        upload_id: str = os.urandom(8).hex()
+        try:
+            with open(file_path, 'rb') as file:
+                chunk: int = 0
+                offset: int = 0
+                data: bytes = file.read(chunk_size)
+                while True:
+                    # Read one chunk ahead to know which one is the last
+                    next_data: bytes = file.read(chunk_size)
+                    last_chunk: bool = not next_data
+
+                    client_message = {
+                        'destination': destination,
+                        'message': name,
+                        'is_file': True,
+                        'upload_id': upload_id,
+                        'chunk': chunk,
+                        'offset': offset,
+                        'last_chunk': last_chunk
+                    }
+                    self.send_frame(encode_data(client_message, data))
+
+                    if last_chunk:
+                        break
+                    chunk += 1
+                    offset += len(data)
+                    data = next_data
+
+            print(f"File sent to {destination} -> {name} in {chunk + 1} chunks")
+            return upload_id
+        except Exception as ex:
+            print(f"Failed to send file: {ex}")
+            return None
+
+    def send_frame(self, frame: bytes) -> None:
+        with self.send_lock:
+            self.client.sendall(frame)
+
+    def on_message(self, callback: Callable[[Dict], None]) -> None:
+        """ Call callback with every delivery, on the receive loop's thread. """
+        self.callbacks.append(callback)
+
+    async def messages(self) -> AsyncIterator[Dict]:
+        """ Deliveries as an async iterator, ending when the connection closes. """
+        loop = asyncio.get_running_loop()
+        deliveries: asyncio.Queue = asyncio.Queue()
+        subscriber = (loop, deliveries)
+        self.subscribers.append(subscriber)
+        try:
+            while self.running.is_set() or not deliveries.empty():
+                message = await deliveries.get()
+                if message is None:
+                    return
+                yield message
+        finally:
+            self.subscribers.remove(subscriber)
+
+    def receive_loop(self) -> None:
+        # Replies may come framed or as plain concatenated JSON, the decoder splits both
+        decoder = FrameDecoder(BUFFER_SIZE)
+        try:
+            while self.running.is_set():
+                if not decoder.recv_into(self.client):
+                    break
+                for frame_type, payload in decoder.frames():
+                    if frame_type == FRAME_JSON:
+                        self.dispatch(load_json(payload))
+        except Exception as ex:
+            if self.running.is_set():
+                print(f"Failed to receive message: {ex}")
+        finally:
+            self.running.clear()
+            self.dispatch(None)
+
+    def dispatch(self, message: Optional[Dict]) -> None:
+        # None tells the readers that the connection is closed
+        for loop, deliveries in list(self.subscribers):
+            loop.call_soon_threadsafe(deliveries.put_nowait, message)
+        if message is not None:
+            for callback in list(self.callbacks):
+                try:
+                    callback(message)
+                except Exception as ex:
+                    print(f"Message callback failed: {ex}")
+        if message is None or not (self.callbacks or self.subscribers):
+            self.inbox.put(message)
+
+    def receive_message(self, timeout: float = None) -> Optional[Dict]:
         try:
-            data = self.client.recv(1024).decode('utf-8')
-            data_loaded = json.loads(data)
+            data_loaded = self.inbox.get(timeout=timeout)
+            if data_loaded is None:
+                # Closed, the next caller is told as well
+                self.inbox.put(None)
+                return None
             print(data_loaded)
-        except Exception as e:
-            print(f"Failed to receive message: {e}")
+            return data_loaded
+        except queue.Empty:
+            print("Failed to receive message: timed out")
+            return None
 
     def stop(self):
         if self.client:
+            self.running.clear()
+            try:
+                self.client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             self.client.close()
             print("Client Stopped.")
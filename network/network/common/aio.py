@@ -0,0 +1,198 @@
+import asyncio
+import socket
+import threading
+from typing import Callable, Set, Tuple
+
+from network.common.delivery import CLIENT_BUFFER_BYTES, DROP, BLOCK, DISCONNECT
+from network.common.utils import debug_warning
+
+
+class LoopThread:
+    """ An asyncio event loop running in its own thread, driven from regular code. """
+
+    def __init__(self, name: str) -> None:
+        self.loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name=name)
+        self.thread.start()
+        self.tasks: Set[asyncio.Task] = set()
+
+    def run(self, coroutine):
+        # Run a coroutine on the loop from a regular thread and wait for its result
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def call_soon(self, callback, *args) -> None:
+        # Streams belong to the loop, so calls from other threads are handed over to it
+        if threading.current_thread() is self.thread:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def spawn(self, coroutine) -> asyncio.Task:
+        # Only from the loop thread; tasks are kept until done so stop() can cancel them
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def cancel_tasks(self) -> None:
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+class LoopConnection:
+    """
+    Socket-like wrapper around a StreamWriter that can be used from any thread.
+
+    sendall() never blocks the caller: data is written on the loop and drained in the background,
+    and a peer that does not take its data within write_timeout is disconnected.
+    """
+
+    def __init__(self, loop_thread: LoopThread, writer: asyncio.StreamWriter, write_timeout: float = 10.0) -> None:
+        self.loop_thread: LoopThread = loop_thread
+        self.writer: asyncio.StreamWriter = writer
+        self.write_timeout: float = write_timeout
+        self.draining: bool = False
+
+    def sendall(self, data: bytes) -> None:
+        self.loop_thread.call_soon(self._write, data)
+
+    def _write(self, data: bytes) -> None:
+        if self.writer.is_closing():
+            return
+        self.writer.write(data)
+        if not self.draining:
+            self.draining = True
+            self.loop_thread.spawn(self._drain())
+
+    async def _drain(self) -> None:
+        try:
+            await asyncio.wait_for(self.writer.drain(), self.write_timeout)
+        except (asyncio.TimeoutError, OSError):
+            self.writer.close()
+        finally:
+            self.draining = False
+
+    def shutdown(self, how: int) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.loop_thread.call_soon(self.writer.close)
+
+
+class LoopOutbox:
+    """
+    Deliveries to one local client on the event loop, without a writer thread of its own.
+
+    The client's transport buffers them, and once max_bytes are waiting in it a delivery is dropped,
+    waits until the buffer drains (block), or the client is disconnected, depending on the overflow
+    policy. Only threads other than the loop may block in put().
+    """
+
+    def __init__(self,
+                 name: str,
+                 client: LoopConnection,
+                 address: Tuple[str, int],
+                 on_close: Callable[[socket.socket, Tuple[str, int]], None],
+                 max_bytes: int = CLIENT_BUFFER_BYTES,
+                 overflow: str = DROP
+                 ) -> None:
+        if overflow not in (DROP, BLOCK, DISCONNECT):
+            raise ValueError(f"Unknown overflow policy {overflow}")
+
+        self.NAME = f"{name} | Outbox {address}"
+        self.client: LoopConnection = client
+        self.address: Tuple[str, int] = address
+        self.on_close = on_close
+        self.overflow: str = overflow
+        self.max_bytes: int = max_bytes
+        self.transport: asyncio.WriteTransport = client.writer.transport
+
+        # Bytes handed to the loop but not in the transport yet, and blocked callers waiting for room
+        self.pending: int = 0
+        self.waiting: int = 0
+        self.watching: bool = False
+        self.room = threading.Condition()
+
+        self.dropped: int = 0
+        self.closed: bool = False
+
+        # The transport pauses its writer at the same size, so a drain ends once there is room again
+        client.loop_thread.call_soon(self.transport.set_write_buffer_limits, max_bytes)
+
+    def buffered(self) -> int:
+        return self.pending + self.transport.get_write_buffer_size()
+
+    def put(self, data: bytes) -> bool:
+        """ Queue one delivery, returns False if it was not queued. """
+        with self.room:
+            if self.closed or self.client.writer.is_closing():
+                return False
+            full: bool = self.buffered() >= self.max_bytes
+            if full and self.overflow == BLOCK:
+                # Waits for room, but not for a client that went away meanwhile
+                self.waiting += 1
+                self._watch_drain()
+                try:
+                    while full and not self.closed:
+                        self.room.wait(1.0)
+                        full = self.buffered() >= self.max_bytes
+                finally:
+                    self.waiting -= 1
+                if self.closed:
+                    return False
+            if not full:
+                self.pending += len(data)
+                self.client.loop_thread.call_soon(self._write, data)
+                return True
+
+        if self.overflow == DISCONNECT:
+            debug_warning(self.NAME,
+                          f"Disconnecting slow client, {self.buffered()} bytes waiting")
+            self.on_close(self.client, self.address)
+            return False
+
+        self.dropped += 1
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            debug_warning(self.NAME,
+                          f"Client buffer full, {self.dropped} deliveries dropped")
+        return False
+
+    def _write(self, data: bytes) -> None:
+        self.client.sendall(data)
+        with self.room:
+            self.pending -= len(data)
+            if not self.waiting:
+                return
+            if self.transport.get_write_buffer_size() < self.max_bytes:
+                self.room.notify_all()
+            else:
+                self._watch_drain()
+
+    def _watch_drain(self) -> None:
+        # Called with the room lock held, one task at a time wakes the waiters once the transport drains
+        if not self.watching:
+            self.watching = True
+            self.client.loop_thread.call_soon(self.client.loop_thread.spawn, self._notify_drained())
+
+    async def _notify_drained(self) -> None:
+        try:
+            await self.client.writer.drain()
+        except Exception:
+            # A client that went away is closed by its reader, which wakes the waiters too
+            pass
+        finally:
+            with self.room:
+                self.watching = False
+                self.room.notify_all()
+
+    def close(self) -> None:
+        with self.room:
+            self.closed = True
+            self.room.notify_all()
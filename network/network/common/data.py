@@ -1,8 +1,11 @@
+import base64
+import itertools
 import json
 import os
-from typing import List, Dict
+import zlib
+from typing import List, Dict, Optional, Tuple
 
-from network.common.utils import debug_warning
+from network.common.transfer import store_file
 
 ROOT_DIR: str = (
     os.path.dirname(
@@ -12,6 +15,21 @@ ROOT_DIR: str = (
     )
 )
 
+# Format of the stored route snapshots, files without a version are the old indented tables
+ROUTES_VERSION = 2
+
+# Step between the turns of messages without a flow over a route's paths
+GOLDEN_RATIO = (5 ** 0.5 - 1) / 2
+
+
+def node_id(name: str) -> int:
+    """ Fixed-size id of a router, for headers that only carry the destination. """
+    return zlib.crc32(name.encode('utf-8'))
+
+
+def flow_id(flow: str = None) -> int:
+    return zlib.crc32(flow.encode('utf-8')) if flow else 0
+
 
 class DataNode:
     def __init__(self, name: str, ip: str, port: int, public_key: str = ""):
@@ -38,28 +56,118 @@ class DataNode:
         )
 
 
+class NodeDirectory:
+    """ Nodes shared by a set of routes, referenced by their position in the directory. """
+
+    def __init__(self, nodes: List[DataNode] = None):
+        self.nodes: List[DataNode] = []
+        self.ids: Dict[str, int] = {}
+        for node in nodes or []:
+            self.add(node)
+
+    def add(self, node: DataNode) -> int:
+        node_id = self.ids.get(node.name)
+        if node_id is None:
+            node_id = len(self.nodes)
+            self.nodes.append(node)
+            self.ids[node.name] = node_id
+        return node_id
+
+    def __getitem__(self, node_id: int) -> DataNode:
+        return self.nodes[node_id]
+
+    def __dict__(self):
+        return [[node.name, node.ip, node.port, node.public_key] for node in self.nodes]
+
+    @classmethod
+    def from_json(cls, json_data: List):
+        return cls([DataNode(name, ip, port, public_key) for name, ip, port, public_key in json_data])
+
+
 class DataRoute:
-    def __init__(self, source: DataNode, destination: DataNode, paths: List[DataNode]):
+    def __init__(self, source: DataNode, destination: DataNode, paths: List[DataNode],
+                 alternatives: List[List[DataNode]] = None, costs: List[int] = None):
         self.source: DataNode = source
         self.destination: DataNode = destination
         self.paths: List[DataNode] = paths
 
+        # Other loop-free paths to the destination, and the cost of every path with the shortest one first
+        self.alternatives: List[List[DataNode]] = alternatives or []
+        self.costs: List[int] = costs or []
+
+        # Share of the traffic up to each path, cheaper paths get more
+        self.cumulative: List[float] = []
+        if self.alternatives:
+            count: int = len(self.alternatives) + 1
+            weights = [1 / cost for cost in self.costs] if len(self.costs) == count else [1.0] * count
+            total = sum(weights)
+            self.cumulative = list(itertools.accumulate(weight / total for weight in weights))
+        self.sequence = itertools.count()
+
     def __dict__(self):
-        return {
+        data = {
             "source": self.source.__dict__(),
             "destination": self.destination.__dict__(),
             "path": [node.__dict__() for node in self.paths]
         }
+        if self.alternatives:
+            data["alternatives"] = [[node.__dict__() for node in path] for path in self.alternatives]
+            data["costs"] = self.costs
+        return data
+
+    def compact(self, directory: NodeDirectory) -> List:
+        """ [source id, destination id, [path ids]] against a shared directory, plus alternatives and costs. """
+        route = [
+            directory.add(self.source),
+            directory.add(self.destination),
+            [directory.add(node) for node in self.paths]
+        ]
+        if self.alternatives:
+            route.append([[directory.add(node) for node in path] for path in self.alternatives])
+            route.append(self.costs)
+        return route
+
+    def path_for(self, flow: str = None) -> List[DataNode]:
+        """
+        Path for one message. A flow always takes the same path, picked by its hash, and messages
+        without one take turns. Both spread over the paths in proportion to their weight.
+        """
+        if not self.alternatives:
+            return self.paths
+        if flow:
+            point: float = flow_id(flow) / 2 ** 32
+        else:
+            # Golden ratio steps cover [0, 1) evenly, so the turns follow the weights closely
+            point = (next(self.sequence) * GOLDEN_RATIO) % 1.0
+        for path, cumulative in zip([self.paths, *self.alternatives], self.cumulative):
+            if point < cumulative:
+                return path
+        return self.alternatives[-1]
 
     @classmethod
-    def from_json(cls, json_data: Dict):
+    def from_json(cls, json_data, directory: NodeDirectory = None):
+        if directory is not None:
+            source_id, destination_id, path_ids, *multipath = json_data
+            alternatives, costs = multipath or ([], [])
+            return cls(
+                source=directory[source_id],
+                destination=directory[destination_id],
+                paths=[directory[node_id] for node_id in path_ids],
+                alternatives=[[directory[node_id] for node_id in path] for path in alternatives],
+                costs=costs
+            )
+
         source: DataNode = DataNode.from_json(json_data['source'])
         destination: DataNode = DataNode.from_json(json_data['destination'])
         paths: List[DataNode] = [DataNode.from_json(data) for data in json_data['path']]
+        alternatives: List[List[DataNode]] = [[DataNode.from_json(data) for data in path]
+                                              for path in json_data.get('alternatives', [])]
         return cls(
             source=source,
             destination=destination,
-            paths=paths
+            paths=paths,
+            alternatives=alternatives,
+            costs=json_data.get('costs', [])
         )
 
 
@@ -74,8 +182,26 @@ class NodeRoutes:
             "routes": [route.__dict__() for route in self.routes]
         }
 
+    def compact(self) -> Dict:
+        """ Same routes with every node sent once in a directory and referenced by id. """
+        directory: NodeDirectory = NodeDirectory()
+        node_id: int = directory.add(self.node)
+        routes: List = [route.compact(directory) for route in self.routes]
+        return {
+            "nodes": directory.__dict__(),
+            "node": node_id,
+            "routes": routes
+        }
+
     @classmethod
     def from_json(cls, json_data: Dict):
+        if "nodes" in json_data:
+            directory: NodeDirectory = NodeDirectory.from_json(json_data['nodes'])
+            return cls(
+                node=directory[json_data['node']],
+                routes=[DataRoute.from_json(data, directory) for data in json_data['routes']]
+            )
+
         node: DataNode = DataNode.from_json(json_data['node'])
         routes: List[DataRoute] = [DataRoute.from_json(data) for data in json_data['routes']]
         return cls(
@@ -94,21 +220,46 @@ class NodeRoutes:
 
 
 class DataMessage:
-    def __init__(self, message: str, path: List[DataNode], key: str = "", is_file: bool = False, binary: str = ""):
+    def __init__(self, message: str, path: List[DataNode], key: str = "", is_file: bool = False, binary: bytes = b"",
+                 transfer_id: str = "", chunk: int = 0, offset: int = 0, last_chunk: bool = False, key_id: str = ""):
         self.message: str = message
         self.path: List[DataNode] = path
         self.key: str = key
+        self.key_id: str = key_id
         self.is_file: bool = is_file
-        self.binary: str = binary
+        self.binary: bytes = binary
+
+        # Chunk of a streamed file transfer, when transfer_id is set
+        self.transfer_id: str = transfer_id
+        self.chunk: int = chunk
+        self.offset: int = offset
+        self.last_chunk: bool = last_chunk
 
     def __dict__(self):
-        return {
+        # JSON form, the binary goes base64 encoded
+        data = self.header()
+        data["binary"] = base64.b64encode(self.binary).decode('utf-8')
+        return data
+
+    def header(self, path: bool = True):
+        # Everything but the binary, which travels raw behind it in a data frame. Without the path when
+        # the routers on the way forward by destination
+        data = {
             "message": self.message,
-            "path": [path.__dict__() for path in self.path],
+            "path": [node.__dict__() for node in self.path] if path else [],
             "key": self.key,
-            "is_file": self.is_file,
-            "binary": self.binary
+            "is_file": self.is_file
         }
+        if self.key_id:
+            data["key_id"] = self.key_id
+        if self.transfer_id:
+            data.update({
+                "transfer_id": self.transfer_id,
+                "chunk": self.chunk,
+                "offset": self.offset,
+                "last_chunk": self.last_chunk
+            })
+        return data
 
     def is_current_node(self, node: str) -> bool:
         return self.path and self.path[0].name == node
@@ -118,11 +269,8 @@ class DataMessage:
 
     @classmethod
     def is_message(cls, message: Dict) -> bool:
-        try:
-            DataMessage.from_json(message)
-            return True
-        except Exception:
-            return False
+        # Only the shape is checked, the message is parsed once by whoever handles it
+        return 'message' in message and isinstance(message.get('path'), list)
 
     @classmethod
     def from_json(cls, json_data: Dict):
@@ -130,39 +278,47 @@ class DataMessage:
         path: List[DataNode] = [DataNode.from_json(data) for data in json_data['path']]
         key: str = json_data.get('key', '')
         is_file: bool = json_data.get('is_file', False)
-        binary: str = json_data.get('binary', "")
+        binary: bytes = json_data.get('binary', b"")
+        if isinstance(binary, str):
+            binary = base64.b64decode(binary)
         return cls(
             message=message,
             path=path,
             key=key,
             is_file=is_file,
-            binary=binary
+            binary=binary,
+            transfer_id=json_data.get('transfer_id', ""),
+            chunk=json_data.get('chunk', 0),
+            offset=json_data.get('offset', 0),
+            last_chunk=json_data.get('last_chunk', False),
+            key_id=json_data.get('key_id', "")
         )
 
 
-def store_route(name: str, routes: NodeRoutes):
-    filename: str = f"routes_{name}.json"
-    file_path: str = os.path.join(ROOT_DIR, "routes", filename)
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    with open(file_path, "w") as f:
-        json.dump(routes.__dict__(), f, indent=4)
+def route_file(name: str) -> str:
+    return os.path.join(ROOT_DIR, "routes", f"routes_{name}.json")
+
 
+def store_route(name: str, routes: NodeRoutes, epoch: int = None):
+    """ Write a compact, versioned snapshot of the table through a temp file, so readers never see half of it. """
+    snapshot = {
+        "version": ROUTES_VERSION,
+        "epoch": epoch,
+        "routes": routes.compact()
+    }
+    store_file(route_file(name), json.dumps(snapshot, separators=(",", ":")).encode('utf-8'))
 
-def read_route_for(name: str, destination: str):
-    filename: str = f"routes_{name}.json"
-    file_path: str = os.path.join(ROOT_DIR, "routes", filename)
 
-    # Check if the file exists
+def load_routes(name: str) -> Optional[Tuple[NodeRoutes, Optional[int]]]:
+    """ Last stored table of a router and its epoch, also from the old indented files. """
+    file_path: str = route_file(name)
     if not os.path.exists(file_path):
-        debug_warning(f"DATA.PY for node: {name}",
-                      f"Route file not found for {name}")
         return None
 
-    # Read and parse the JSON file
     with open(file_path, "r") as f:
         data = json.load(f)
-        node_routes: NodeRoutes = NodeRoutes.from_json(data)
-
-    # Find the specific route to the given destination
-    route: DataRoute = next((route for route in node_routes.routes if route.destination.name == destination), None)
-    return route
+    if "version" not in data:
+        return NodeRoutes.from_json(data), None
+    if data["version"] > ROUTES_VERSION:
+        raise ValueError(f"Unknown route file version {data['version']}")
+    return NodeRoutes.from_json(data["routes"]), data.get("epoch")
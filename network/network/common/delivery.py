@@ -0,0 +1,120 @@
+import queue
+import socket
+import threading
+from typing import Callable, List, Tuple
+
+from network.common.utils import debug_log, debug_warning
+
+# What happens to a delivery when a client's queue is full
+DROP = "drop"
+BLOCK = "block"
+DISCONNECT = "disconnect"
+
+# Deliveries queued per client
+CLIENT_QUEUE_SIZE = 1024
+
+# Bytes waiting to be written to a client on an event loop before its overflow policy applies
+CLIENT_BUFFER_BYTES = 1024 * 1024
+
+# Queued deliveries written together in one sendall
+WRITE_BATCH_BYTES = 64 * 1024
+
+
+class ClientOutbox:
+    """
+    Outbound queue and writer thread for one local client, so a slow client only holds up itself.
+
+    When the queue is full, a delivery is dropped, waits for room (block), or the client is
+    disconnected, depending on the overflow policy.
+    """
+
+    def __init__(self,
+                 name: str,
+                 client: socket.socket,
+                 address: Tuple[str, int],
+                 on_close: Callable[[socket.socket, Tuple[str, int]], None],
+                 queue_size: int = CLIENT_QUEUE_SIZE,
+                 overflow: str = DROP
+                 ) -> None:
+        if overflow not in (DROP, BLOCK, DISCONNECT):
+            raise ValueError(f"Unknown overflow policy {overflow}")
+
+        self.NAME = f"{name} | Outbox {address}"
+        self.client: socket.socket = client
+        self.address: Tuple[str, int] = address
+        self.on_close = on_close
+        self.overflow: str = overflow
+
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.dropped: int = 0
+        self.closed: bool = False
+
+        self.thread = threading.Thread(target=self.write_loop, name=self.NAME, daemon=True)
+        self.thread.start()
+
+    def put(self, data: bytes) -> bool:
+        """ Queue one delivery, returns False if it was not queued. """
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(data)
+            return True
+        except queue.Full:
+            pass
+
+        if self.overflow == BLOCK:
+            # Waits for room, but not for a client that went away meanwhile
+            while not self.closed:
+                try:
+                    self.queue.put(data, timeout=1.0)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        if self.overflow == DISCONNECT:
+            debug_warning(self.NAME,
+                          f"Disconnecting slow client, {self.queue.qsize()} deliveries queued")
+            self.on_close(self.client, self.address)
+            return False
+
+        self.dropped += 1
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            debug_warning(self.NAME,
+                          f"Client queue full, {self.dropped} deliveries dropped")
+        return False
+
+    def write_loop(self) -> None:
+        try:
+            while not self.closed:
+                data = self.queue.get()
+                if data is None or self.closed:
+                    break
+
+                # Whatever queued up meanwhile goes out in the same write
+                batch: List[bytes] = [data]
+                size: int = len(data)
+                while size < WRITE_BATCH_BYTES:
+                    try:
+                        data = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if data is None:
+                        break
+                    batch.append(data)
+                    size += len(data)
+
+                self.client.sendall(b"".join(batch))
+        except OSError as ex:
+            if not self.closed:
+                debug_log(self.NAME,
+                          f"Delivery failed: {ex}")
+                self.on_close(self.client, self.address)
+
+    def close(self) -> None:
+        self.closed = True
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            # The writer sees the flag with its next delivery
+            pass
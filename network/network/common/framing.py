@@ -0,0 +1,253 @@
+import codecs
+import json
+import socket
+import struct
+from typing import Dict, Iterator, Optional, Tuple, Union
+
+BUFFER_SIZE = 1024 * 1024
+MIN_RECV_SIZE = 64 * 1024
+
+# Bytes read and written at a time when relaying a frame that is still arriving
+RELAY_CHUNK_SIZE = 64 * 1024
+
+# Frame header: magic, version, type, reserved, payload length
+FRAME_MAGIC = 0xC5
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("!BBBxI")
+HEADER_SIZE = FRAME_HEADER.size
+
+# Frame types
+FRAME_JSON = 1
+FRAME_DATA = 2
+FRAME_PING = 3
+FRAME_PROBE = 4
+FRAME_FORWARD = 5
+
+# FRAME_DATA payload: header length, JSON header, raw binary body
+DATA_HEADER = struct.Struct("!I")
+
+# FRAME_PING payload: the sender's heartbeat interval in milliseconds, then any RTTs measured to its
+# neighbours since the last ping, each one as name length, name and RTT in microseconds
+PING = struct.Struct("!I")
+PING_RTT = struct.Struct("!HI")
+
+# FRAME_FORWARD payload: destination id, TTL, flow id and sequence number, then a FRAME_DATA payload
+# that only the destination reads
+FORWARD = struct.Struct("!IBxII")
+
+# FRAME_PROBE payload: the sender's clock when it sent the probe, echoed back by the receiving router
+PROBE = struct.Struct("!d")
+
+JSON_WHITESPACE = b" \t\r\n"
+
+
+def encode_frame(payload: bytes, frame_type: int = FRAME_JSON) -> bytes:
+    return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, frame_type, len(payload)) + payload
+
+
+def encode_json(message: Dict) -> bytes:
+    return encode_frame(json.dumps(message).encode('utf-8'), FRAME_JSON)
+
+
+def encode_data(header: Dict, binary: bytes = b"") -> bytes:
+    header_bytes = json.dumps(header).encode('utf-8')
+    payload = b"".join((DATA_HEADER.pack(len(header_bytes)), header_bytes, binary))
+    return encode_frame(payload, FRAME_DATA)
+
+
+def encode_forward(destination_id: int, ttl: int, flow_id: int, sequence: int, header: Dict,
+                   binary: bytes = b"") -> bytes:
+    header_bytes = json.dumps(header).encode('utf-8')
+    length = FORWARD.size + DATA_HEADER.size + len(header_bytes) + len(binary)
+    return b"".join((encode_forward_header(length, destination_id, ttl, flow_id, sequence),
+                     DATA_HEADER.pack(len(header_bytes)), header_bytes, binary))
+
+
+def encode_forward_header(length: int, destination_id: int, ttl: int, flow_id: int, sequence: int) -> bytes:
+    """ Frame header and forward header of a FRAME_FORWARD frame with a payload of length bytes. """
+    return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, FRAME_FORWARD, length) + \
+        FORWARD.pack(destination_id, ttl, flow_id, sequence & 0xFFFFFFFF)
+
+
+def encode_ping(interval: float, rtts: Dict[str, float] = None) -> bytes:
+    parts = [PING.pack(int(interval * 1000))]
+    for name, rtt in (rtts or {}).items():
+        name_bytes = name.encode('utf-8')
+        parts.append(PING_RTT.pack(len(name_bytes), int(rtt * 1000000)))
+        parts.append(name_bytes)
+    return encode_frame(b"".join(parts), FRAME_PING)
+
+
+def decode_ping(payload: bytes) -> Tuple[float, Dict[str, float]]:
+    """ The interval and the neighbour RTTs of a ping, in seconds. """
+    (interval,) = PING.unpack_from(payload)
+    rtts: Dict[str, float] = {}
+    position = PING.size
+    while position < len(payload):
+        name_length, rtt = PING_RTT.unpack_from(payload, position)
+        position += PING_RTT.size
+        rtts[payload[position:position + name_length].decode('utf-8')] = rtt / 1000000
+        position += name_length
+    return interval / 1000, rtts
+
+
+def decode_data(payload: bytes, offset: int = 0) -> Tuple[Dict, memoryview]:
+    # The body is returned as a view, so it is not copied again
+    (header_length,) = DATA_HEADER.unpack_from(payload, offset)
+    header_start = offset + DATA_HEADER.size
+    body_start = header_start + header_length
+    header = json.loads(payload[header_start:body_start])
+    return header, memoryview(payload)[body_start:]
+
+
+def load_json(payload: Union[bytes, Dict]) -> Dict:
+    # Messages from the plain JSON stream come out of the decoder already parsed
+    if isinstance(payload, dict):
+        return payload
+    return json.loads(payload)
+
+
+class FrameDecoder:
+    """
+    Splits a byte stream into (frame type, payload) pairs.
+
+    Data is received straight into a preallocated buffer that only grows when a single frame does
+    not fit. A connection whose first byte is not the frame magic is read as the plain
+    concatenated-JSON stream instead, and its messages come out already parsed.
+    """
+
+    def __init__(self, buffer_size: int = BUFFER_SIZE) -> None:
+        self.buffer_size: int = buffer_size
+        self.buffer: bytearray = bytearray(buffer_size)
+        self.start: int = 0
+        self.end: int = 0
+        self.needed: int = HEADER_SIZE
+
+        # Plain JSON compatibility mode
+        self.legacy: bool = None
+        self.text: str = ""
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+
+    def recv_into(self, sock: socket.socket, limit: Optional[int] = None) -> int:
+        """
+        Receive from the socket into the free end of the buffer, returns 0 on EOF. With a limit the
+        buffer grows by at most that much for the frame in progress.
+        """
+        self._reserve(max(self.needed if limit is None else min(self.needed, limit), MIN_RECV_SIZE))
+        received = sock.recv_into(memoryview(self.buffer)[self.end:])
+        self.end += received
+        return received
+
+    def feed(self, data: bytes) -> None:
+        self._reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def _reserve(self, size: int) -> None:
+        pending = self.end - self.start
+        if len(self.buffer) > self.buffer_size and pending + size <= self.buffer_size:
+            # The oversized frame it grew for is gone, so the buffer goes back to its usual size
+            buffer = bytearray(self.buffer_size)
+            buffer[:pending] = self.buffer[self.start:self.end]
+            self.buffer, self.start, self.end = buffer, 0, pending
+            return
+        if len(self.buffer) - self.end >= size:
+            return
+        # Move the pending bytes to the front, then grow only if a single frame still does not fit
+        if self.start:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+        if len(self.buffer) - pending < size:
+            self.buffer.extend(bytes(pending + size - len(self.buffer)))
+
+    def frames(self) -> Iterator[Tuple[int, Union[bytes, Dict]]]:
+        """ Yield every complete frame in the buffer, leaving a partial one for the next receive. """
+        if self.legacy is None:
+            while self.start < self.end and self.buffer[self.start] in JSON_WHITESPACE:
+                self.start += 1
+            if self.start == self.end:
+                return
+            self.legacy = self.buffer[self.start] != FRAME_MAGIC
+
+        if self.legacy:
+            yield from self._json_messages()
+            return
+
+        while self.end - self.start >= HEADER_SIZE:
+            magic, version, frame_type, length = FRAME_HEADER.unpack_from(self.buffer, self.start)
+            if magic != FRAME_MAGIC or version != FRAME_VERSION:
+                raise ValueError(f"Invalid frame header (magic {magic:#x}, version {version})")
+
+            frame_end = self.start + HEADER_SIZE + length
+            if frame_end > self.end:
+                self.needed = frame_end - self.end
+                return
+
+            payload = bytes(memoryview(self.buffer)[self.start + HEADER_SIZE:frame_end])
+            self.start = frame_end
+            if self.start == self.end:
+                self.start = self.end = 0
+            self.needed = HEADER_SIZE
+            yield frame_type, payload
+
+    def pending_frame(self) -> Optional[Tuple[int, int, int]]:
+        """ Type, payload length and payload bytes received of the incomplete frame, once its header is in. """
+        if self.legacy is not False or self.end - self.start < HEADER_SIZE:
+            return None
+        _, _, frame_type, length = FRAME_HEADER.unpack_from(self.buffer, self.start)
+        return frame_type, length, self.end - self.start - HEADER_SIZE
+
+    def partial(self) -> Optional[Tuple[int, int, memoryview]]:
+        """ Type, payload length and the payload received so far of the incomplete frame in the buffer. """
+        if self.legacy is not False or self.end - self.start < HEADER_SIZE:
+            return None
+        _, _, frame_type, length = FRAME_HEADER.unpack_from(self.buffer, self.start)
+        return frame_type, length, memoryview(self.buffer)[self.start + HEADER_SIZE:self.end]
+
+    def discard_partial(self) -> None:
+        # The rest of the incomplete frame is read by whoever took it, the next bytes start a new frame
+        self.start = self.end = 0
+        self.needed = HEADER_SIZE
+
+    def _json_messages(self) -> Iterator[Tuple[int, Dict]]:
+        self.text += self.utf8.decode(bytes(self.buffer[self.start:self.end]))
+        self.start = self.end = 0
+
+        while self.text:
+            try:
+                # Try to parse the buffer as a JSON message
+                message_json, end_index = json.JSONDecoder().raw_decode(self.text)
+            except json.JSONDecodeError:
+                # Not enough data to decode a full message
+                return
+            self.text = self.text[end_index:].lstrip()
+            yield FRAME_JSON, message_json
+
+
+class FrameRelay:
+    """
+    The rest of one frame, read from a socket as it arrives, so it can be written on before it is
+    complete. Iterating yields the given head and then each received chunk, and the chunk buffer is
+    reused, so every chunk must be written before the next one is taken.
+    """
+
+    def __init__(self, sock: socket.socket, head: bytes, remaining: int, chunk_size: int = RELAY_CHUNK_SIZE) -> None:
+        self.sock: socket.socket = sock
+        self.head: bytes = head
+        self.remaining: int = remaining
+        self.buffer: bytearray = bytearray(min(chunk_size, remaining) or 1)
+
+    def __iter__(self) -> Iterator[Union[bytes, memoryview]]:
+        yield self.head
+        view = memoryview(self.buffer)
+        while self.remaining:
+            received = self.sock.recv_into(view, min(self.remaining, len(self.buffer)))
+            if not received:
+                raise ConnectionError("Connection closed in the middle of a frame")
+            self.remaining -= received
+            yield view[:received]
+
+    def drain(self) -> None:
+        """ Read and drop what is left of the frame, so the socket is at a frame boundary again. """
+        for _ in self:
+            pass
@@ -0,0 +1,86 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey, RSAPublicKey
+
+from network.common.security import generate_keys, serialize_key_private, deserialize_key_private
+
+
+class Identity:
+    """
+    A router's RSA keypair, which may still be loading or generating in the background.
+
+    private_key and public_key wait for the keypair only when they are first used, so the rest of the
+    router can be set up meanwhile.
+    """
+
+    def __init__(self, keys: Future) -> None:
+        self.keys: Future = keys
+
+    @property
+    def private_key(self) -> RSAPrivateKey:
+        return self.keys.result()[0]
+
+    @property
+    def public_key(self) -> RSAPublicKey:
+        return self.keys.result()[1]
+
+    @classmethod
+    def from_keys(cls, private_key: RSAPrivateKey, public_key: RSAPublicKey):
+        keys: Future = Future()
+        keys.set_result((private_key, public_key))
+        return cls(keys)
+
+    @classmethod
+    def in_background(cls, key_dir: Optional[str] = None, name: str = ""):
+        # Loads name's keypair from key_dir, or generates one (stored in key_dir if given) on its own thread
+        keys: Future = Future()
+
+        def load() -> None:
+            try:
+                keys.set_result(load_or_generate_keys(key_dir, name) if key_dir else generate_keys())
+            except Exception as ex:
+                keys.set_exception(ex)
+
+        threading.Thread(target=load, name=f"Keys | {name}", daemon=True).start()
+        return cls(keys)
+
+
+def load_or_generate_keys(key_dir: str, name: str) -> Tuple[RSAPrivateKey, RSAPublicKey]:
+    """ Load name's keypair from key_dir, generating and storing it there the first time. """
+    file_path: str = os.path.join(key_dir, f"{name}.pem")
+    if os.path.exists(file_path):
+        with open(file_path, "rb") as f:
+            private_key: RSAPrivateKey = deserialize_key_private(f.read())
+        return private_key, private_key.public_key()
+
+    private_key, public_key = generate_keys()
+    os.makedirs(key_dir, exist_ok=True)
+
+    # Private key file readable by the owner only, renamed into place so it is never seen half written
+    temp_path: str = f"{file_path}.{os.getpid()}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(serialize_key_private(private_key))
+    os.replace(temp_path, file_path)
+    return private_key, public_key
+
+
+class KeyPool:
+    """ Keypairs generated ahead of time on a thread pool, to bring up many routers without waiting on RSA. """
+
+    def __init__(self, size: int, workers: Optional[int] = None) -> None:
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="KeyPool")
+        self.keys: List[Future] = [self.executor.submit(generate_keys) for _ in range(size)]
+        self.lock = threading.Lock()
+
+    def take(self) -> Identity:
+        # Once the pool is used up every identity is generated on demand
+        with self.lock:
+            keys: Future = self.keys.pop(0) if self.keys else self.executor.submit(generate_keys)
+        return Identity(keys)
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
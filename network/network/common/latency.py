@@ -0,0 +1,55 @@
+from typing import Dict, Optional, Tuple
+
+# Weight of a new RTT sample in the moving average
+RTT_ALPHA = 0.3
+
+# Change from the current weight below which a link keeps it, relative and in milliseconds of RTT
+RTT_HYSTERESIS = 0.2
+RTT_MIN_CHANGE = 0.5
+
+# Weight per millisecond of RTT. Light in fiber covers about 100 km per millisecond of round trip, so
+# measured weights line up with the configured distances
+RTT_WEIGHT_PER_MS = 100
+
+
+class LinkLatency:
+    """
+    Smoothed RTT per link, turned into a new link weight only when it moved far enough.
+
+    Each end of a link has its own average, since a probe's echo waits on the router at the other end,
+    and the link counts as slow as its slower direction. The hysteresis keeps jitter from recomputing
+    routes, and two near-equal paths from swapping back and forth.
+    """
+
+    def __init__(self,
+                 alpha: float = RTT_ALPHA,
+                 hysteresis: float = RTT_HYSTERESIS,
+                 min_change: float = RTT_MIN_CHANGE,
+                 weight_per_ms: float = RTT_WEIGHT_PER_MS
+                 ) -> None:
+        self.alpha: float = alpha
+        self.hysteresis: float = hysteresis
+        self.min_change: float = min_change * weight_per_ms
+        self.weight_per_ms: float = weight_per_ms
+
+        # (measuring router, neighbour) -> smoothed RTT in seconds
+        self.smoothed: Dict[Tuple[str, str], float] = {}
+
+    def sample(self, u: str, v: str, rtt: float, weight: int) -> Optional[int]:
+        """ Add an RTT in seconds measured by u, returns the new weight if it differs enough from weight. """
+        previous: Optional[float] = self.smoothed.get((u, v))
+        first: bool = previous is None and (v, u) not in self.smoothed
+        self.smoothed[(u, v)] = rtt if previous is None else previous + self.alpha * (rtt - previous)
+
+        slowest: float = max(self.smoothed[(u, v)], self.smoothed.get((v, u), 0.0))
+        new_weight: int = max(1, round(slowest * 1000 * self.weight_per_ms))
+
+        # The configured weight gives way to the first measurement
+        change: int = abs(new_weight - weight)
+        if not first and (change <= weight * self.hysteresis or change < self.min_change):
+            return None
+        return new_weight if change else None
+
+    def remove(self, name: str) -> None:
+        for link in [link for link in self.smoothed if name in link]:
+            del self.smoothed[link]
@@ -0,0 +1,88 @@
+import heapq
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class Liveness:
+    """
+    Heartbeat deadlines per router on a lazy min-heap.
+
+    A ping only moves the router's deadline in a dict, which is O(1). Each router has one live heap
+    entry, and an entry that comes due with a moved deadline is pushed again at the new one. So the
+    cost per router is one heap operation per timeout period, however often it pings, and finding the
+    expired routers never scans the healthy ones.
+    """
+
+    def __init__(self, default_timeout: float) -> None:
+        self.default_timeout: float = default_timeout
+        self.deadlines: Dict[str, float] = {}
+        self.timeouts: Dict[str, float] = {}
+
+        # Heap of (deadline, name), entries whose deadline is not the one in entries are stale
+        self.heap: List[Tuple[float, str]] = []
+        self.entries: Dict[str, float] = {}
+
+        # Its own lock, so pings never wait on route computation
+        self.lock = threading.Lock()
+
+    def add(self, name: str, timeout: Optional[float] = None) -> None:
+        timeout = timeout or self.default_timeout
+        with self.lock:
+            self.timeouts[name] = timeout
+            self.deadlines[name] = time.time() + timeout
+            self._arm(name, self.deadlines[name])
+
+    def touch(self, name: str, timeout: Optional[float] = None) -> None:
+        """ Record a ping, optionally with a new timeout for this router. """
+        with self.lock:
+            if name not in self.deadlines:
+                return
+            if timeout and timeout != self.timeouts[name]:
+                self.timeouts[name] = timeout
+                self.deadlines[name] = time.time() + timeout
+                # A shorter timeout may need an earlier entry
+                self._arm(name, self.deadlines[name])
+            else:
+                self.deadlines[name] = time.time() + self.timeouts[name]
+
+    def _arm(self, name: str, deadline: float) -> None:
+        # Called with the lock held, only pushes when the live entry would come due too late
+        entry = self.entries.get(name)
+        if entry is None or deadline < entry:
+            self.entries[name] = deadline
+            heapq.heappush(self.heap, (deadline, name))
+
+    def remove(self, name: str) -> None:
+        # Its heap entry is dropped once it comes due
+        with self.lock:
+            self.deadlines.pop(name, None)
+            self.timeouts.pop(name, None)
+
+    def expired(self, now: float = None) -> List[str]:
+        """ Routers whose deadline has passed, they are no longer tracked afterwards. """
+        now = now or time.time()
+        expired: List[str] = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                entry, name = heapq.heappop(self.heap)
+                if self.entries.get(name) != entry:
+                    continue
+                del self.entries[name]
+
+                deadline = self.deadlines.get(name)
+                if deadline is None:
+                    continue
+                if deadline > now:
+                    self._arm(name, deadline)
+                    continue
+
+                del self.deadlines[name]
+                del self.timeouts[name]
+                expired.append(name)
+        return expired
+
+    def next_deadline(self) -> Optional[float]:
+        # The earliest entry may be stale, then this is just an early wake-up
+        with self.lock:
+            return self.heap[0][0] if self.heap else None
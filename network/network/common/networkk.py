@@ -1,18 +1,44 @@
-from typing import List
-from networkx import Graph, dijkstra_path, NetworkXNoPath
+from typing import List, Dict, Optional, Set, Tuple
+from networkx import Graph, dijkstra_path, single_source_dijkstra, NetworkXNoPath
 
 from network.common.data import DataRoute, DataNode, NodeRoutes
 
+# Paths per destination, the shortest one included
+MAX_PATHS = 3
+
+# Alternative paths may cost at most this many times the shortest one
+MAX_STRETCH = 1.25
+
 
 class Network:
 
-    def __init__(self):
+    def __init__(self, max_paths: int = MAX_PATHS, max_stretch: float = MAX_STRETCH):
         """" Initialize the network Graph """
         self.graph: Graph = Graph()
 
+        # Multipath, each alternative leaves the source through another neighbour (1 disables it)
+        self.max_paths: int = max_paths
+        self.max_stretch: float = max_stretch
+
+        # Shortest-path tree per source: (distances, paths, nodes that are some path's parent hop)
+        self._trees: Dict[str, Tuple[Dict[str, int], Dict[str, List[str]], Set[str]]] = {}
+
+        # Sources whose routes changed since the last pop_changed()
+        self._changed: Set[str] = set()
+
     def add_edge(self, u: str, v: str, w: int) -> None:
         """ Add an edge to the graph with a specified weight if the nodes and weight are valid. """
         if isinstance(w, int) and w > 0:
+            if u not in self.graph or v not in self.graph:
+                # A new node is a new destination for everybody
+                self._invalidate(set(self._trees))
+                self._changed.update(self.graph.nodes())
+                self._changed.update((u, v))
+            else:
+                self._invalidate(self._sources_affected_by_edge(u, v, w))
+            if self.max_paths > 1 or not self.graph.has_edge(u, v):
+                # Both ends get another neighbour, or another cost through it
+                self._changed.update((u, v))
             self.graph.add_edge(u, v, weight=w)
         else:
             print(f"Invalid weight {w}; must be a positive integer.")
@@ -25,17 +51,70 @@ class Network:
             port=node.port,
             public_key=node.public_key
         )
+        # Paths are unchanged, but every table holds this node as a destination
+        self._changed.update(self.graph.nodes())
 
     def remove_node(self, node: DataNode) -> None:
         """Remove a node from the graph if it exists."""
         if node.name in self.graph:
+            affected = {source for source, (_, _, parents) in self._trees.items() if node.name in parents}
+            affected.add(node.name)
+            self._invalidate(affected)
             self.graph.remove_node(node.name)
+
+            # In the remaining trees the node is a leaf, so only its own entry goes away
+            for distances, paths, _ in self._trees.values():
+                distances.pop(node.name, None)
+                paths.pop(node.name, None)
+
+            # Every remaining table loses this destination, only the affected ones need a new tree
+            self._changed.update(self.graph.nodes())
+            self._changed.discard(node.name)
         else:
             print(f"Node {node} not found in the graph.")
 
+    def _sources_affected_by_edge(self, u: str, v: str, w: int) -> Set[str]:
+        """Sources whose shortest-path tree may change when edge (u, v) gets weight w."""
+        old_weight = self.graph.edges[u, v]["weight"] if self.graph.has_edge(u, v) else None
+        if old_weight == w:
+            return set()
+
+        affected = set()
+        for source, (distances, paths, _) in self._trees.items():
+            if old_weight is None or w < old_weight:
+                # A new or cheaper edge matters if it reaches either end at least as cheaply
+                du = distances.get(u)
+                dv = distances.get(v)
+                if du is None and dv is None:
+                    continue
+                if dv is None or du is None or du + w <= dv or dv + w <= du:
+                    affected.add(source)
+            else:
+                # A more expensive edge only matters if the tree uses it
+                if paths.get(v, [])[-2:] == [u, v] or paths.get(u, [])[-2:] == [v, u]:
+                    affected.add(source)
+        return affected
+
+    def _invalidate(self, sources: Set[str]) -> None:
+        for source in sources:
+            self._trees.pop(source, None)
+        self._changed.update(sources)
+        if self.max_paths > 1:
+            # Alternatives go through a neighbour's tree, so the neighbours' routes change as well
+            for source in sources:
+                if source in self.graph:
+                    self._changed.update(self.graph.neighbors(source))
+
     def get_all_nodes(self) -> List[str]:
         return self.graph.nodes()
 
+    def edge_weight(self, u: str, v: str) -> Optional[int]:
+        return self.graph.edges[u, v]["weight"] if self.graph.has_edge(u, v) else None
+
+    def neighbours_of(self, node: str) -> List[DataNode]:
+        """ The routers directly linked to node. """
+        return [self.node_to_datanode(neighbour) for neighbour in self.graph.neighbors(node)]
+
     def shortest_path(self, start: str, end: str) -> list[str]:
         """Find the shortest path from start to end using Dijkstra's algorithm."""
         try:
@@ -47,6 +126,45 @@ class Network:
             print(f"Error calculating path from {start} to {end}: {ex}")
             return []
 
+    def shortest_paths_from(self, start: str) -> Dict[str, List[str]]:
+        """Find the shortest paths from start to every reachable node with a single Dijkstra run."""
+        if start not in self._trees:
+            try:
+                distances, paths = single_source_dijkstra(self.graph, start)
+            except Exception as ex:
+                print(f"Error calculating paths from {start}: {ex}")
+                return {}
+            parents = {path[-2] for path in paths.values() if len(path) > 1}
+            self._trees[start] = (distances, paths, parents)
+        return self._trees[start][1]
+
+    def alternative_paths(self, start: str) -> Dict[str, List[Tuple[int, List[str]]]]:
+        """
+        Up to max_paths - 1 other paths from start to every node, cheapest first. Each one takes a
+        neighbour other than the shortest path's first hop and continues on that neighbour's shortest path,
+        so it is loop-free as long as it does not come back through start, and it may cost at most
+        max_stretch times the shortest path. Only the cached trees are needed.
+        """
+        paths: Dict[str, List[str]] = self.shortest_paths_from(start)
+        if start not in self._trees:
+            return {}
+        distances: Dict[str, int] = self._trees[start][0]
+
+        candidates: Dict[str, List[Tuple[int, List[str]]]] = {}
+        for neighbor, edge in self.graph[start].items():
+            neighbor_paths: Dict[str, List[str]] = self.shortest_paths_from(neighbor)
+            if neighbor not in self._trees:
+                continue
+            neighbor_distances: Dict[str, int] = self._trees[neighbor][0]
+            for target, path in neighbor_paths.items():
+                if target == start or start in path or paths[target][1] == neighbor:
+                    continue
+                cost: int = edge["weight"] + neighbor_distances[target]
+                if cost <= distances[target] * self.max_stretch:
+                    candidates.setdefault(target, []).append((cost, [start, *path]))
+
+        return {target: sorted(found)[:self.max_paths - 1] for target, found in candidates.items()}
+
     def node_to_datanode(self, node: str) -> DataNode:
         """"  """
         node_data = self.graph.nodes[node]
@@ -58,16 +176,27 @@ class Network:
             public_key=node_data.get('public_key')
         )
 
-    def _generate_data_route(self, source: str, target: str, path: List[str]) -> DataRoute:
-        """"  """
-        paths_data = [self.node_to_datanode(node) for node in path]
-        source_data: DataNode = self.node_to_datanode(source)
-        destination_data: DataNode = self.node_to_datanode(target)
+    def _generate_data_route(self, source: str, target: str, path: List[str],
+                             data_nodes: Dict[str, DataNode] = None,
+                             alternatives: List[Tuple[int, List[str]]] = None, cost: int = 0) -> DataRoute:
+        """" Build a DataRoute, reusing the DataNode objects in data_nodes when given """
+        if data_nodes is None:
+            data_nodes = {}
+        alternatives = alternatives or []
+        for node in (source, target, *path, *(node for _, other in alternatives for node in other)):
+            if node not in data_nodes:
+                data_nodes[node] = self.node_to_datanode(node)
+
+        paths_data = [data_nodes[node] for node in path]
+        source_data: DataNode = data_nodes[source]
+        destination_data: DataNode = data_nodes[target]
 
         route_data: DataRoute = DataRoute(
             source=source_data,
             destination=destination_data,
-            paths=paths_data
+            paths=paths_data,
+            alternatives=[[data_nodes[node] for node in other] for _, other in alternatives],
+            costs=[cost, *(other_cost for other_cost, _ in alternatives)] if alternatives else []
         )
 
         return route_data
@@ -81,13 +210,28 @@ class Network:
 
         return all_routes
 
+    def pop_changed(self) -> Set[str]:
+        """ Return the sources whose routes changed since the last call and reset the tracking. """
+        changed = {node for node in self._changed if node in self.graph}
+        self._changed = set()
+        return changed
+
     def get_routes_for(self, node: str) -> NodeRoutes:
         all_routes = []
         data_node: DataNode = self.node_to_datanode(node)
+        data_nodes: Dict[str, DataNode] = {node: data_node}
+        paths: Dict[str, List[str]] = self.shortest_paths_from(node)
+        alternatives = self.alternative_paths(node) if self.max_paths > 1 else {}
+        distances: Dict[str, int] = self._trees[node][0] if node in self._trees else {}
         for target in self.graph.nodes():
             if node != target:
-                path: List[str] = self.shortest_path(node, target)
-                route_data: DataRoute = self._generate_data_route(node, target, path)
+                path: List[str] = paths.get(target)
+                if path is None:
+                    print(f"No path found from {node} to {target}.")
+                    path = []
+                route_data: DataRoute = self._generate_data_route(node, target, path, data_nodes,
+                                                                  alternatives.get(target),
+                                                                  distances.get(target, 0))
 
                 all_routes.append(route_data)
 
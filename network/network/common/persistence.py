@@ -0,0 +1,85 @@
+import threading
+import time
+from typing import Optional, Tuple
+
+from network.common.data import NodeRoutes, store_route, load_routes
+from network.common.utils import debug_exception, debug_warning
+
+# Updates within this many seconds of the first unsaved one are written as one snapshot
+STORE_DELAY = 0.5
+
+
+class RouteStore:
+    """
+    Write-behind persistence of one router's routing table.
+
+    save() only keeps the latest table and returns, a background thread writes it delay seconds after
+    the first unsaved update. So a burst of updates costs one write, and the control thread never
+    waits for the disk.
+    """
+
+    def __init__(self, name: str, delay: float = STORE_DELAY) -> None:
+        self.NAME = f"{name} | Routes"
+        self.name: str = name
+        self.delay: float = delay
+
+        # Latest table not written yet
+        self.pending: Optional[Tuple[NodeRoutes, Optional[int]]] = None
+        self.save_at: float = 0.0
+        self.ready = threading.Condition()
+        self.writer: Optional[threading.Thread] = None
+        self.running: bool = True
+
+        # Snapshots are written one at a time, by the writer or by flush()
+        self.write_lock = threading.Lock()
+
+    def load(self) -> Optional[Tuple[NodeRoutes, Optional[int]]]:
+        """ The last stored table and its epoch, None when there is none or it cannot be read. """
+        try:
+            return load_routes(self.name)
+        except Exception as ex:
+            debug_warning(self.NAME,
+                          f"Ignoring stored routes: {ex}")
+            return None
+
+    def save(self, routes: NodeRoutes, epoch: int = None) -> None:
+        with self.ready:
+            if self.pending is None:
+                self.save_at = time.time() + self.delay
+            self.pending = (routes, epoch)
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._write_due, name=self.NAME, daemon=True)
+                self.writer.start()
+            self.ready.notify()
+
+    def _write_due(self) -> None:
+        while self.running:
+            with self.ready:
+                if self.pending is None:
+                    self.ready.wait()
+                    continue
+                remaining = self.save_at - time.time()
+                if remaining > 0:
+                    self.ready.wait(remaining)
+                    continue
+            self.flush()
+
+    def flush(self) -> None:
+        """ Write the pending table now. """
+        with self.write_lock:
+            with self.ready:
+                pending = self.pending
+                self.pending = None
+            if pending is None:
+                return
+            try:
+                store_route(self.name, *pending)
+            except Exception as ex:
+                debug_exception(self.NAME,
+                                f"Failed to store routes: {ex}")
+
+    def close(self) -> None:
+        with self.ready:
+            self.running = False
+            self.ready.notify()
+        self.flush()
@@ -0,0 +1,287 @@
+import select
+import socket
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from network.common.utils import debug_log, debug_warning, debug_exception
+
+# Connections idle for longer than this are checked before reuse
+HEALTH_CHECK_AFTER = 1.0
+
+# Coalesced frames are written once this many bytes are waiting
+COALESCE_BYTES = 64 * 1024
+
+
+class PooledConnection:
+    def __init__(self, address: Tuple[str, int]) -> None:
+        self.address: Tuple[str, int] = address
+        self.sock: Optional[socket.socket] = None
+        self.last_used: float = 0.0
+
+        # Reconnect backoff
+        self.failures: int = 0
+        self.retry_at: float = 0.0
+
+        # Serializes writes so frames from different threads never interleave
+        self.lock = threading.Lock()
+
+        # Frames waiting to be written together, when coalescing
+        self.pending: List[bytes] = []
+        self.pending_bytes: int = 0
+        self.flush_at: float = 0.0
+
+
+class ConnectionPool:
+    """
+    Long-lived connections to neighbour routers, keyed by (ip, port).
+
+    A connection is opened on first use and reused for every later message. Connections that were
+    idle for a while are checked before reuse, failed connects back off exponentially, and
+    connections idle for longer than idle_timeout are closed.
+
+    With a coalesce_window, frames for the same address are gathered for up to that many seconds, or
+    until coalesce_bytes are waiting, and written with a single sendall. Frames are length-prefixed,
+    so the receiver splits them again as usual.
+
+    Frames streamed with send_stream go over a second long-lived connection per address, so a slow
+    stream never holds up the regular frames.
+    """
+
+    def __init__(self,
+                 name: str,
+                 hello: bytes = b"",
+                 idle_timeout: float = 60.0,
+                 connect_timeout: float = 5.0,
+                 backoff_initial: float = 0.5,
+                 backoff_max: float = 30.0,
+                 coalesce_window: float = 0.0,
+                 coalesce_bytes: int = COALESCE_BYTES
+                 ) -> None:
+        self.NAME = f"{name} | Pool"
+
+        # First bytes sent on every new connection
+        self.hello: bytes = hello
+
+        self.idle_timeout: float = idle_timeout
+        self.connect_timeout: float = connect_timeout
+        self.backoff_initial: float = backoff_initial
+        self.backoff_max: float = backoff_max
+
+        self.connections: Dict[Tuple[str, int], PooledConnection] = {}
+        self.streams: Dict[Tuple[str, int], PooledConnection] = {}
+        self.next_eviction: float = time.time() + idle_timeout
+        self.lock = threading.Lock()
+
+        # Coalescing, the flusher thread writes batches whose window is over
+        self.coalesce_window: float = coalesce_window
+        self.coalesce_bytes: int = coalesce_bytes
+        self.flushing: Set[PooledConnection] = set()
+        self.flush_ready = threading.Condition()
+        self.flusher: Optional[threading.Thread] = None
+        self.running: bool = True
+
+    def send(self, address: Tuple[str, int], data: bytes) -> None:
+        self.evict_idle()
+
+        with self.lock:
+            connection = self.connections.get(address)
+            if connection is None:
+                connection = PooledConnection(address)
+                self.connections[address] = connection
+
+        if not self.coalesce_window:
+            with connection.lock:
+                self._write(connection, data)
+            return
+
+        with self.flush_ready:
+            if not connection.pending:
+                connection.flush_at = time.time() + self.coalesce_window
+                self.flushing.add(connection)
+                self._start_flusher()
+                self.flush_ready.notify()
+            connection.pending.append(data)
+            connection.pending_bytes += len(data)
+            full: bool = connection.pending_bytes >= self.coalesce_bytes
+
+        # A full batch is written right away by the sender
+        if full:
+            self.flush(connection)
+
+    def send_stream(self, address: Tuple[str, int], chunks: Iterable[bytes]) -> None:
+        """
+        Write one frame chunk by chunk as the chunks come, on the address's stream connection. Streams
+        to the same address wait for each other, and one that fails part way closes the connection,
+        so the receiver never reads the next frame as the rest of this one.
+        """
+        self.evict_idle()
+
+        with self.lock:
+            connection = self.streams.get(address)
+            if connection is None:
+                connection = PooledConnection(address)
+                self.streams[address] = connection
+
+        with connection.lock:
+            chunks = iter(chunks)
+            # Nothing of the frame is out before the first chunk, so it may still retry on a new connection
+            self._write(connection, next(chunks))
+            try:
+                for chunk in chunks:
+                    connection.sock.sendall(chunk)
+                connection.last_used = time.time()
+            except Exception:
+                self._close(connection)
+                raise
+
+    def flush(self, connection: PooledConnection) -> None:
+        # The batch is taken with the write lock held, so batches go out in the order they were filled
+        with connection.lock:
+            with self.flush_ready:
+                batch: List[bytes] = connection.pending
+                connection.pending = []
+                connection.pending_bytes = 0
+                self.flushing.discard(connection)
+            if batch:
+                self._write(connection, b"".join(batch))
+
+    def _start_flusher(self) -> None:
+        # Called with flush_ready held
+        if self.flusher is None:
+            self.flusher = threading.Thread(target=self._flush_due, name=f"{self.NAME} | Flusher", daemon=True)
+            self.flusher.start()
+
+    def _flush_due(self) -> None:
+        while self.running:
+            with self.flush_ready:
+                now = time.time()
+                due: List[PooledConnection] = [c for c in self.flushing if c.flush_at <= now]
+                if not due:
+                    next_flush = min((c.flush_at for c in self.flushing), default=now + self.idle_timeout)
+                    self.flush_ready.wait(next_flush - now)
+                    continue
+
+            for connection in due:
+                try:
+                    self.flush(connection)
+                except Exception as ex:
+                    debug_exception(self.NAME,
+                                    f"Failed to send batch to {connection.address}: {ex}")
+
+    def _write(self, connection: PooledConnection, data: bytes) -> None:
+        # Called with connection.lock held
+        # A pooled connection may have died since its last use, so retry once on a fresh one
+        for attempt in range(2):
+            sock = self._connected(connection)
+            try:
+                sock.sendall(data)
+                connection.last_used = time.time()
+                return
+            except OSError:
+                self._close(connection)
+                if attempt:
+                    raise
+
+    def _connected(self, connection: PooledConnection) -> socket.socket:
+        if connection.sock is not None:
+            if time.time() - connection.last_used < HEALTH_CHECK_AFTER or self._is_alive(connection.sock):
+                return connection.sock
+            debug_warning(self.NAME,
+                          f"Connection to {connection.address} went away, reconnecting")
+            self._close(connection)
+
+        now = time.time()
+        if now < connection.retry_at:
+            raise ConnectionError(f"{connection.address} unreachable, retrying in {connection.retry_at - now:.1f}s")
+
+        try:
+            sock = self._open(connection.address)
+        except OSError:
+            connection.failures += 1
+            delay = min(self.backoff_max, self.backoff_initial * 2 ** (connection.failures - 1))
+            connection.retry_at = time.time() + delay
+            raise
+
+        connection.sock = sock
+        connection.failures = 0
+        connection.retry_at = 0.0
+        connection.last_used = time.time()
+        debug_log(self.NAME,
+                  f"Connected to {connection.address}")
+        return sock
+
+    def _open(self, address: Tuple[str, int]) -> socket.socket:
+        sock = socket.create_connection(address, timeout=self.connect_timeout)
+        try:
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.hello:
+                sock.sendall(self.hello)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    @staticmethod
+    def _is_alive(sock: socket.socket) -> bool:
+        # Neighbours never write on these connections, so readable means closed or reset
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            if not readable:
+                return True
+            return sock.recv(1, socket.MSG_PEEK) != b""
+        except (OSError, ValueError):
+            return False
+
+    @staticmethod
+    def _close(connection: PooledConnection) -> None:
+        if connection.sock is not None:
+            try:
+                connection.sock.close()
+            except OSError:
+                pass
+            connection.sock = None
+
+    def evict_idle(self) -> None:
+        now = time.time()
+        if now < self.next_eviction:
+            return
+        self.next_eviction = now + self.idle_timeout / 2
+
+        with self.lock:
+            connections = [*self.connections.values(), *self.streams.values()]
+
+        for connection in connections:
+            if connection.sock is None or now - connection.last_used <= self.idle_timeout:
+                continue
+            # Skip connections that are busy sending right now
+            if connection.lock.acquire(blocking=False):
+                try:
+                    debug_log(self.NAME,
+                              f"Closing idle connection to {connection.address}")
+                    self._close(connection)
+                finally:
+                    connection.lock.release()
+
+    def close_all(self) -> None:
+        with self.flush_ready:
+            self.running = False
+            pending: List[PooledConnection] = list(self.flushing)
+            self.flush_ready.notify()
+
+        # Last batches go out before their connections are closed
+        for connection in pending:
+            try:
+                self.flush(connection)
+            except Exception:
+                pass
+
+        with self.lock:
+            connections = [*self.connections.values(), *self.streams.values()]
+            self.connections.clear()
+            self.streams.clear()
+
+        for connection in connections:
+            with connection.lock:
+                self._close(connection)
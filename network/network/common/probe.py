@@ -0,0 +1,117 @@
+import socket
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from network.common.framing import FrameDecoder, FRAME_PROBE, PROBE, MIN_RECV_SIZE, encode_frame
+from network.common.utils import debug_log
+
+# Seconds between two rounds of probes to every neighbour (0 disables probing)
+PROBE_INTERVAL = 5.0
+
+# A probe without an echo within this long is lost, and its connection is dropped
+PROBE_TIMEOUT = 1.0
+
+
+class LinkProber:
+    """
+    Measures the round trip to each neighbour router, for the controller to weigh the links by.
+
+    Every neighbour gets a connection of its own, announced with the hello frame like the pooled ones,
+    and a probe frame on it every interval. The neighbour echoes it from its worker stage, so the RTT
+    includes the time a busy router takes to get to it. The latest RTT per neighbour is kept until the
+    next heartbeat takes it.
+    """
+
+    def __init__(self,
+                 name: str,
+                 hello: bytes,
+                 interval: float = PROBE_INTERVAL,
+                 timeout: float = PROBE_TIMEOUT
+                 ) -> None:
+        self.NAME = f"{name} | Prober"
+        self.hello: bytes = hello
+        self.interval: float = interval
+        self.timeout: float = timeout
+
+        # Neighbour name -> address, as sent by the controller
+        self.neighbours: Dict[str, Tuple[str, int]] = {}
+        self.connections: Dict[str, Tuple[Tuple[str, int], socket.socket, FrameDecoder]] = {}
+
+        # RTTs not reported yet
+        self.samples: Dict[str, float] = {}
+
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+
+    def set_neighbours(self, neighbours: Dict[str, Tuple[str, int]]) -> None:
+        with self.lock:
+            self.neighbours = neighbours
+            if self.thread is None and self.interval and not self.stopped.is_set():
+                self.thread = threading.Thread(target=self.probe_loop, name=self.NAME, daemon=True)
+                self.thread.start()
+
+    def take(self) -> Dict[str, float]:
+        """ RTTs measured since the last call. """
+        with self.lock:
+            samples, self.samples = self.samples, {}
+        return samples
+
+    def probe_loop(self) -> None:
+        while not self.stopped.is_set():
+            with self.lock:
+                neighbours = dict(self.neighbours)
+
+            # Connections to routers that are no longer neighbours are closed
+            for name in [name for name in self.connections if name not in neighbours]:
+                self._drop(name)
+
+            for name, address in neighbours.items():
+                if self.stopped.is_set():
+                    break
+                rtt: Optional[float] = self.probe(name, address)
+                if rtt is not None:
+                    with self.lock:
+                        self.samples[name] = rtt
+
+            self.stopped.wait(self.interval)
+
+    def probe(self, name: str, address: Tuple[str, int]) -> Optional[float]:
+        try:
+            connection = self.connections.get(name)
+            if connection is None or connection[0] != address:
+                self._drop(name)
+                sock = socket.create_connection(address, timeout=self.timeout)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.sendall(self.hello)
+                connection = (address, sock, FrameDecoder(MIN_RECV_SIZE))
+                self.connections[name] = connection
+            _, sock, decoder = connection
+
+            sent: float = time.perf_counter()
+            sock.sendall(encode_frame(PROBE.pack(sent), FRAME_PROBE))
+            while True:
+                for frame_type, payload in decoder.frames():
+                    # Echoes of probes that timed out earlier are skipped
+                    if frame_type == FRAME_PROBE and PROBE.unpack(payload)[0] == sent:
+                        return time.perf_counter() - sent
+                if not decoder.recv_into(sock):
+                    raise ConnectionError("Connection closed")
+        except Exception as ex:
+            debug_log(self.NAME,
+                      f"Probe to {name} failed: {ex}")
+            self._drop(name)
+            return None
+
+    def _drop(self, name: str) -> None:
+        connection = self.connections.pop(name, None)
+        if connection is not None:
+            connection[1].close()
+
+    def close(self) -> None:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(self.timeout * 2)
+        for name in list(self.connections):
+            self._drop(name)
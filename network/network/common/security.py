@@ -1,5 +1,7 @@
 import base64
 import os
+from functools import lru_cache
+from typing import Union
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
@@ -13,38 +15,50 @@ def generate_symmetric_key() -> bytes:
     return AESGCM.generate_key(bit_length=128)
 
 
-def encrypt_message(message: str, key: bytes) -> str:
-    aesgcm = AESGCM(key)
+def aead(key: Union[bytes, AESGCM]) -> AESGCM:
+    # Session keys come with their AESGCM already built, raw keys get a new one
+    return key if isinstance(key, AESGCM) else AESGCM(key)
+
+
+def encrypt_message(message: str, key: Union[bytes, AESGCM]) -> str:
+    aesgcm = aead(key)
     nonce = os.urandom(12)
     encrypted = aesgcm.encrypt(nonce, message.encode('utf-8'), None)
     return base64.b64encode(nonce + encrypted).decode('utf-8')
 
 
-def decrypt_message(encrypted_message: str, key: bytes) -> str:
+def decrypt_message(encrypted_message: str, key: Union[bytes, AESGCM]) -> str:
     encrypted_message = base64.b64decode(encrypted_message)
     nonce = encrypted_message[:12]
     ciphertext = encrypted_message[12:]
-    aesgcm = AESGCM(key)
+    aesgcm = aead(key)
     decrypted = aesgcm.decrypt(nonce, ciphertext, None)
     return decrypted.decode('utf-8')
 
 
-def encrypt_file(file_data: bytes, key: bytes) -> str:
-    aesgcm = AESGCM(key)
+def encrypt_file(file_data: bytes, key: Union[bytes, AESGCM], associated_data: bytes = None) -> bytes:
+    # Raw nonce + ciphertext, the wire carries it as a binary frame body
+    aesgcm = aead(key)
     nonce = os.urandom(12)
-    encrypted = aesgcm.encrypt(nonce, file_data, None)
-    return base64.b64encode(nonce + encrypted).decode('utf-8')
+    encrypted = aesgcm.encrypt(nonce, file_data, associated_data)
+    return nonce + encrypted
 
 
-def decrypt_file(encrypted_file: str, key: bytes) -> bytes:
-    encrypted_file = base64.b64decode(encrypted_file)
+def decrypt_file(encrypted_file: Union[bytes, str], key: Union[bytes, AESGCM], associated_data: bytes = None) -> bytes:
+    if isinstance(encrypted_file, str):
+        encrypted_file = base64.b64decode(encrypted_file)
     nonce = encrypted_file[:12]
     ciphertext = encrypted_file[12:]
-    aesgcm = AESGCM(key)
-    decrypted = aesgcm.decrypt(nonce, ciphertext, None)
+    aesgcm = aead(key)
+    decrypted = aesgcm.decrypt(nonce, ciphertext, associated_data)
     return decrypted
 
 
+def chunk_associated_data(transfer_id: str, chunk: int, offset: int, last_chunk: bool) -> bytes:
+    # Binds every sealed chunk to its transfer, index and write offset, so chunks cannot be moved or cut off
+    return f"{transfer_id}:{chunk}:{offset}:{int(last_chunk)}".encode('utf-8')
+
+
 def generate_keys() -> (RSAPrivateKey, RSAPublicKey):
     private_key: RSAPrivateKey = rsa.generate_private_key(
         public_exponent=65537,
@@ -63,6 +77,10 @@ def serialize_key_private(key: RSAPrivateKey) -> bytes:
     )
 
 
+def deserialize_key_private(pem: bytes) -> RSAPrivateKey:
+    return serialization.load_pem_private_key(pem, password=None, backend=default_backend())
+
+
 def serialize_key_public(key: RSAPublicKey) -> str:
     pem = key.public_bytes(
         encoding=serialization.Encoding.PEM,
@@ -71,6 +89,7 @@ def serialize_key_public(key: RSAPublicKey) -> str:
     return pem.decode('utf-8')
 
 
+@lru_cache(maxsize=1024)
 def deserialize_key_public(key_str: str) -> RSAPublicKey:
     return serialization.load_pem_public_key(key_str.encode('utf-8'), backend=default_backend())
 
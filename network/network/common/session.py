@@ -0,0 +1,93 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from network.common.keys import Identity
+from network.common.security import generate_symmetric_key, encrypt_symmetric_key, decrypt_symmetric_key
+
+# Session keys are rotated after this many messages or seconds
+SESSION_MAX_MESSAGES = 100000
+SESSION_MAX_AGE = 3600.0
+
+# Unwrapped session keys kept by the receiving side
+SESSION_CACHE = 1024
+
+
+class OutgoingSession:
+    def __init__(self, public_key: str) -> None:
+        self.key_id: str = os.urandom(8).hex()
+        self.public_key: str = public_key
+        sym_key: bytes = generate_symmetric_key()
+        self.aead: AESGCM = AESGCM(sym_key)
+        self.wrapped_key: str = encrypt_symmetric_key(sym_key, public_key)
+        self.messages: int = 0
+        self.created: float = time.time()
+
+    def expired(self, now: float, max_messages: int, max_age: float) -> bool:
+        return self.messages >= max_messages or now - self.created > max_age
+
+
+class SessionKeys:
+    """
+    AES session keys per destination router, wrapped once with its RSA key and named by a key id.
+
+    Every message carries the key id and the wrapped key, so the destination only has to run RSA the
+    first time it sees a key id and can pick up a session at any point. Sessions are rotated after
+    max_messages messages or max_age seconds, or when the destination's public key changes.
+    """
+
+    def __init__(self,
+                 identity: Identity,
+                 max_messages: int = SESSION_MAX_MESSAGES,
+                 max_age: float = SESSION_MAX_AGE,
+                 cache_size: int = SESSION_CACHE
+                 ) -> None:
+        self.identity: Identity = identity
+        self.max_messages: int = max_messages
+        self.max_age: float = max_age
+        self.cache_size: int = cache_size
+
+        self.outgoing: Dict[str, OutgoingSession] = {}
+        self.incoming: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def for_destination(self, destination: str, public_key: str) -> OutgoingSession:
+        """ Session to seal one message to destination with, a new one when the current one is used up. """
+        now = time.time()
+        with self.lock:
+            session = self.outgoing.get(destination)
+            if session is not None and session.public_key == public_key \
+                    and not session.expired(now, self.max_messages, self.max_age):
+                session.messages += 1
+                return session
+
+        # RSA stays outside of the lock so other destinations are not held up
+        session = OutgoingSession(public_key)
+        session.messages += 1
+        with self.lock:
+            self.outgoing[destination] = session
+        return session
+
+    def key_for_message(self, key_id: str, wrapped_key: str) -> Tuple[bytes, AESGCM]:
+        """ Raw session key and AESGCM for an incoming message, its key is only unwrapped if the key id is new. """
+        if not key_id:
+            sym_key = decrypt_symmetric_key(wrapped_key, self.identity.private_key)
+            return sym_key, AESGCM(sym_key)
+
+        with self.lock:
+            keys = self.incoming.get(key_id)
+            if keys is not None:
+                self.incoming.move_to_end(key_id)
+                return keys
+
+        sym_key = decrypt_symmetric_key(wrapped_key, self.identity.private_key)
+        keys = (sym_key, AESGCM(sym_key))
+        with self.lock:
+            self.incoming[key_id] = keys
+            while len(self.incoming) > self.cache_size:
+                self.incoming.popitem(last=False)
+        return keys
@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+from typing import Optional, Set
+
+# Plaintext bytes per chunk of a streamed file transfer
+CHUNK_SIZE = 256 * 1024
+
+# Transfers without a new chunk for this long are dropped
+TRANSFER_TIMEOUT = 60.0
+
+
+def store_file(file_path: str, data: bytes) -> None:
+    """ Write a whole file next to its final path, then rename it into place. """
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    temp_path: str = f"{file_path}.{os.getpid()}.{threading.get_ident()}.part"
+    with open(temp_path, 'wb') as file:
+        file.write(data)
+    os.replace(temp_path, file_path)
+
+
+class IncomingTransfer:
+    """
+    Reassembles the chunks of one streamed file on disk, in whatever order they arrive.
+
+    Chunks go to a temporary file next to the final path, which only appears once every chunk is in.
+    """
+
+    def __init__(self, transfer_id: str, name: str, file_path: str) -> None:
+        self.transfer_id: str = transfer_id
+        self.name: str = name
+        self.file_path: str = file_path
+        self.temp_path: str = f"{file_path}.{transfer_id}.part"
+
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        self.file = open(self.temp_path, 'wb')
+
+        self.received: Set[int] = set()
+        self.last_chunk: Optional[int] = None
+        self.last_activity: float = time.time()
+        self.lock = threading.Lock()
+
+    def write(self, chunk: int, offset: int, data: bytes, last_chunk: bool) -> bool:
+        """ Write one chunk at its offset, returns True once every chunk of the transfer is on disk. """
+        with self.lock:
+            if chunk in self.received or self.file.closed:
+                return False
+            self.file.seek(offset)
+            self.file.write(data)
+            self.received.add(chunk)
+            if last_chunk:
+                self.last_chunk = chunk
+            self.last_activity = time.time()
+            return self.last_chunk is not None and len(self.received) == self.last_chunk + 1
+
+    def is_stale(self, now: float) -> bool:
+        return now - self.last_activity > TRANSFER_TIMEOUT
+
+    def finish(self) -> None:
+        """ Move the complete file into place. """
+        with self.lock:
+            self.file.close()
+            os.replace(self.temp_path, self.file_path)
+
+    def discard(self) -> None:
+        with self.lock:
+            self.file.close()
+            try:
+                os.remove(self.temp_path)
+            except FileNotFoundError:
+                pass
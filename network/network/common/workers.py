@@ -0,0 +1,167 @@
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Dict, Optional
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from network.common.security import decrypt_file
+from network.common.utils import debug_exception
+
+# Frames waiting for a worker before the readers are held back
+QUEUE_SIZE = 64
+
+# Payloads from this size on are decrypted on the process pool, when there is one
+PROCESS_THRESHOLD = 64 * 1024
+
+# Received payload bytes held in memory at once, across all connections
+MAX_INFLIGHT_BYTES = 64 * 1024 * 1024
+
+
+class WorkerPool:
+    """
+    Execution stage between the connection readers and the message processing.
+
+    Without workers everything runs inline on the reader thread. With workers, items run on a thread
+    pool that holds at most queue_size waiting items. Once it is full, submit() blocks the reader, so an
+    overloaded router stops reading from its sockets instead of buffering without bound. Items may then
+    finish in a different order than they arrived.
+
+    Received payloads submitted with their size count against max_inflight_bytes until they are
+    processed, and readers wait while the cap is reached, whether or not there are workers. Readers
+    reserve a large payload as soon as its frame header says how long it is, before receiving it.
+
+    With process_workers, payloads of at least process_threshold bytes are decrypted on a process pool,
+    where the GIL does not serialize them. It uses the spawn start method, so scripts creating routers
+    need the usual `if __name__ == "__main__"` guard.
+    """
+
+    def __init__(self,
+                 name: str,
+                 workers: int = 0,
+                 queue_size: int = QUEUE_SIZE,
+                 process_workers: int = 0,
+                 process_threshold: int = PROCESS_THRESHOLD,
+                 max_inflight_bytes: int = MAX_INFLIGHT_BYTES
+                 ) -> None:
+        self.NAME = f"{name} | Workers"
+
+        self.executor: Optional[ThreadPoolExecutor] = None
+        if workers:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=self.NAME)
+        self.size: int = workers + queue_size
+        self.slots = threading.Semaphore(self.size)
+
+        self.processes: Optional[ProcessPoolExecutor] = None
+        if process_workers:
+            self.processes = ProcessPoolExecutor(max_workers=process_workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        self.process_threshold: int = process_threshold
+
+        # Stats
+        self.queued: int = 0
+        self.active: int = 0
+        self.completed: int = 0
+        self.blocked: int = 0
+        self.max_queued: int = 0
+        self.lock = threading.Lock()
+
+        # Payload bytes not processed yet
+        self.max_inflight_bytes: int = max_inflight_bytes
+        self.inflight_bytes: int = 0
+        self.inflight_ready = threading.Condition(self.lock)
+        self.running: bool = True
+
+    def submit(self, function, *args, size: int = 0, reserved: bool = False) -> None:
+        """ Run function(*args), size counts against the in-flight cap unless the caller reserved it already. """
+        if not reserved:
+            self.reserve(size)
+        if self.executor is None:
+            # A frame that fails is logged like on the workers, the reader goes on with the next one
+            try:
+                function(*args)
+            except Exception as ex:
+                debug_exception(self.NAME,
+                                f"Error processing message: {ex}")
+            finally:
+                self.release(size)
+            return
+
+        # Backpressure, the reader waits here for a free slot
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.blocked += 1
+            self.slots.acquire()
+
+        with self.lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        try:
+            self.executor.submit(self._run, function, args, size)
+        except RuntimeError:
+            # Shut down meanwhile
+            self.slots.release()
+            self.release(size)
+
+    def reserve(self, size: int) -> None:
+        """ Wait until size more payload bytes fit under the cap, and count them. """
+        if not size or not self.max_inflight_bytes:
+            return
+        with self.inflight_ready:
+            # A payload larger than the whole cap still goes through on its own
+            if self.inflight_bytes and self.inflight_bytes + size > self.max_inflight_bytes:
+                self.blocked += 1
+                self.inflight_ready.wait_for(lambda: not self.running or not self.inflight_bytes
+                                             or self.inflight_bytes + size <= self.max_inflight_bytes)
+            self.inflight_bytes += size
+
+    def release(self, size: int) -> None:
+        if not size or not self.max_inflight_bytes:
+            return
+        with self.inflight_ready:
+            self.inflight_bytes -= size
+            self.inflight_ready.notify_all()
+
+    def _run(self, function, args, size: int) -> None:
+        with self.lock:
+            self.queued -= 1
+            self.active += 1
+        try:
+            function(*args)
+        except Exception as ex:
+            debug_exception(self.NAME,
+                            f"Error processing message: {ex}")
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.completed += 1
+            self.slots.release()
+            self.release(size)
+
+    def decrypt(self, data: bytes, sym_key: bytes, aead: AESGCM, associated_data: bytes = None) -> bytes:
+        if self.processes is not None and len(data) >= self.process_threshold:
+            return self.processes.submit(decrypt_file, bytes(data), sym_key, associated_data).result()
+        return decrypt_file(data, aead, associated_data)
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "queued": self.queued,
+                "active": self.active,
+                "completed": self.completed,
+                "blocked": self.blocked,
+                "max_queued": self.max_queued,
+                "inflight_bytes": self.inflight_bytes
+            }
+
+    def shutdown(self) -> None:
+        with self.inflight_ready:
+            self.running = False
+            self.inflight_ready.notify_all()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            # Readers still waiting for a slot are let go
+            self.slots.release(self.size)
+        if self.processes is not None:
+            # Waited for, so no worker process outlives the router
+            self.processes.shutdown(wait=True, cancel_futures=True)
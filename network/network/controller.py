@@ -1,15 +1,34 @@
-import json
 import socket
 import threading
 import time
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
-from network.common.data import DataNode, NodeRoutes
+from network.common.framing import FrameDecoder, FRAME_JSON, FRAME_PING, encode_json, load_json, decode_ping
+from network.common.data import DataNode, DataRoute, NodeRoutes, NodeDirectory
+from network.common.latency import LinkLatency
+from network.common.liveness import Liveness
 from network.common.networkk import Network
 from network.common.utils import debug_log, debug_exception, debug_warning
 
 BUFFER_SIZE = 1024 * 1024
 
+# Routers are given this long until their first ping says how often they ping
+HEARTBEAT_TIMEOUT = 5.0
+
+# Pings a router may miss before it is considered disconnected
+HEARTBEAT_MISSES = 3
+
+# Longest sleep of the heartbeat checker, so routers joining meanwhile are not checked late
+HEARTBEAT_CHECK_MAX = 0.5
+
+# Topology changes this close together are recomputed as one, but never later than the max delay
+TOPOLOGY_WINDOW = 0.05
+TOPOLOGY_MAX_DELAY = 0.5
+
+# Route tables written to the routers at the same time
+ROUTE_SENDERS = 16
+
 
 class Controller:
     NAME = "Controller"
@@ -17,7 +36,12 @@ class Controller:
     def __init__(self,
                  host: str,
                  port: int,
-                 network: Network
+                 network: Network,
+                 heartbeat_timeout: float = HEARTBEAT_TIMEOUT,
+                 heartbeat_misses: int = HEARTBEAT_MISSES,
+                 topology_window: float = TOPOLOGY_WINDOW,
+                 topology_max_delay: float = TOPOLOGY_MAX_DELAY,
+                 route_senders: int = ROUTE_SENDERS
                  ) -> None:
         # Host and network configuration
         self.host: str = host
@@ -27,10 +51,42 @@ class Controller:
         # Socket configuration & clients
         self.server_socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.clients: Dict[DataNode, socket.socket] = {}
-        self.last_ping_times: Dict[str, float] = {}
+        self.nodes: Dict[str, DataNode] = {}
+
+        # Heartbeat deadlines, each router's timeout follows the interval it pings at
+        self.heartbeat_misses: int = heartbeat_misses
+        self.liveness: Liveness = Liveness(heartbeat_timeout)
+
+        # Last route table sent to each router (destination -> route) and its epoch
+        self.sent_routes: Dict[str, Dict[str, Tuple]] = {}
+        self.route_epochs: Dict[str, int] = {}
+
+        # Neighbours last sent to each router for probing, and the links' smoothed RTTs
+        self.sent_neighbours: Dict[str, Tuple] = {}
+        self.latency: LinkLatency = LinkLatency()
+
+        # Topology changes and resync requests, queued for the scheduler thread. Only that thread changes the
+        # network and recomputes, so joins, leaves and readers never wait for a recompute
+        self.topology_updates: List[Tuple[Callable, Tuple]] = []
+        self.topology_resyncs: Set[str] = set()
+
+        # RTTs reported by the routers, applied by the scheduler as well
+        self.link_samples: List[Tuple[str, Dict[str, float]]] = []
+
+        # Pending route changes, pushed by the scheduler thread in one recompute
+        self.topology_window: float = topology_window
+        self.topology_max_delay: float = topology_max_delay
+        self.topology_pending: bool = False
+        self.topology_first: float = 0.0
+        self.topology_last: float = 0.0
+        self.topology_changed = threading.Condition()
+        self.route_senders: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=route_senders,
+                                                                    thread_name_prefix=f"{self.NAME} | Routes")
 
         # Threading Lock and Event
         self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.topology_lock = threading.Lock()
         self.running = threading.Event()
         self.running.set()
 
@@ -44,9 +100,11 @@ class Controller:
 
             accept_thread = threading.Thread(target=self.accept_connections)
             heartbeat_thread = threading.Thread(target=self.check_heartbeats)
+            topology_thread = threading.Thread(target=self.apply_topology_changes)
 
             accept_thread.start()
             heartbeat_thread.start()
+            topology_thread.start()
 
         except Exception as ex:
             self.server_socket.close()
@@ -58,21 +116,16 @@ class Controller:
             while self.running.is_set():
                 # Accept connections
                 client, address = self.server_socket.accept()
-                auth: bytes = client.recv(BUFFER_SIZE)
-                data_decoded: str = auth.decode("utf-8")
-                data_auth: Dict = json.loads(data_decoded)
+                decoder = FrameDecoder(BUFFER_SIZE)
+                data_auth: Dict = self.read_auth(client, decoder)
                 node: DataNode = DataNode.from_json(data_auth)
 
-                with self.lock:
-                    self.clients[node] = client
-                    self.last_ping_times[node.name] = time.time()
-
-                self.add_node(node)
+                self.register_client(node, client)
 
                 debug_log(self.NAME,
                           f"Connection established with {address}")
 
-                client_thread = threading.Thread(target=self.handle_client, args=(client, node))
+                client_thread = threading.Thread(target=self.handle_client, args=(client, node, decoder))
                 client_thread.start()
 
         except Exception as e:
@@ -80,25 +133,35 @@ class Controller:
                 debug_exception(self.NAME,
                                 f"Error accepting connections: {e}")
 
-    def handle_client(self, client: socket.socket, node: DataNode) -> None:
+    def register_client(self, node: DataNode, client: socket.socket) -> None:
+        with self.lock:
+            self.clients[node] = client
+            self.nodes[node.name] = node
+        self.liveness.add(node.name)
+
+        # Its full snapshot goes out with the next recompute, routers joining together share it
+        self.add_node(node)
+
+    @staticmethod
+    def read_auth(client: socket.socket, decoder: FrameDecoder) -> Dict:
+        # The first message is the router's DataNode; anything after it stays in the decoder
+        while True:
+            for frame_type, payload in decoder.frames():
+                return load_json(payload)
+            if not decoder.recv_into(client):
+                raise ConnectionError("Connection closed before authentication")
+
+    def handle_client(self, client: socket.socket, node: DataNode, decoder: FrameDecoder) -> None:
         try:
-            buffer = ""
             while self.running.is_set():
-                data: bytes = client.recv(BUFFER_SIZE)
-                if not data:
-                    break
+                for frame_type, payload in decoder.frames():
+                    if frame_type == FRAME_PING:
+                        self.process_ping(node, payload)
+                    elif frame_type == FRAME_JSON:
+                        self.process_message(load_json(payload), node)
 
-                buffer += data.decode('utf-8')
-
-                while True:
-                    try:
-                        # Try to parse the buffer as a JSON message
-                        message_json, end_index = json.JSONDecoder().raw_decode(buffer)
-                        buffer = buffer[end_index:].lstrip()
-                        self.process_message(message_json, node)
-                    except json.JSONDecodeError:
-                        # Not enough data to decode a full message
-                        break
+                if not decoder.recv_into(client):
+                    break
         except Exception as ex:
             if self.running.is_set():
                 debug_exception(self.NAME,
@@ -109,70 +172,270 @@ class Controller:
     def process_message(self, message_json: Dict, node: DataNode):
         message_type = message_json.get("type")
         if message_type == "ping":
-            with self.lock:
-                self.last_ping_times[node.name] = time.time()
+            self.liveness.touch(node.name)
+        elif message_type == "resync":
+            debug_warning(self.NAME,
+                          f"{node.name} requested a route resync from epoch {message_json.get('epoch')}")
+            self.request_resync(node)
         else:
             debug_log(self.NAME,
                       f"{node.name} sends: {message_json}")
 
+    def process_ping(self, node: DataNode, payload: bytes) -> None:
+        interval, rtts = decode_ping(payload)
+        self.liveness.touch(node.name, interval * self.heartbeat_misses)
+        if rtts:
+            self.update_link_weights(node.name, rtts)
+
+    def update_link_weights(self, name: str, rtts: Dict[str, float]) -> None:
+        """ Queue the RTTs a router measured, so its reader never waits for a recompute. """
+        with self.topology_changed:
+            self.link_samples.append((name, rtts))
+            self.topology_changed.notify()
+
+    def reweight_links(self, name: str, rtts: Dict[str, float]) -> bool:
+        """ Reweight the links a router measured, returns whether any weight changed. Takes topology_lock held. """
+        changed: bool = False
+        for neighbour, rtt in rtts.items():
+            weight: Optional[int] = self.network.edge_weight(name, neighbour)
+            if weight is None:
+                continue
+            new_weight: Optional[int] = self.latency.sample(name, neighbour, rtt, weight)
+            if new_weight is not None:
+                debug_log(self.NAME,
+                          f"Link {name}-{neighbour} reweighted from {weight} to {new_weight}")
+                self.network.add_edge(name, neighbour, new_weight)
+                changed = True
+        return changed
+
     def check_heartbeats(self):
         while self.running.is_set():
-            current_time = time.time()
-            with self.lock:
-                for node, last_ping in list(self.last_ping_times.items()):
-                    if current_time - last_ping > 10:
-                        debug_warning(self.NAME,
-                                      f"Router {node} is considered disconnected.")
-                        self.remove_client_by_name(node)
-            time.sleep(5)
-
-    def send_routes(self, node: DataNode) -> None:
+            # Sleep until the earliest deadline, only routers that are due get looked at
+            next_deadline: Optional[float] = self.liveness.next_deadline()
+            delay = HEARTBEAT_CHECK_MAX if next_deadline is None else next_deadline - time.time()
+            time.sleep(min(max(delay, 0.01), HEARTBEAT_CHECK_MAX))
+
+            for name in self.liveness.expired():
+                debug_warning(self.NAME,
+                              f"Router {name} is considered disconnected.")
+                self.remove_client_by_name(name)
+
+    def schedule_routes(self) -> None:
+        """ Note a topology change, the scheduler recomputes once the changes stop coming. """
+        with self.topology_changed:
+            now = time.time()
+            if not self.topology_pending:
+                self.topology_pending = True
+                self.topology_first = now
+            self.topology_last = now
+            self.topology_changed.notify()
+
+    def change_topology(self, function: Callable, *args) -> None:
+        """ Queue a change to the network, the scheduler applies it and recomputes. """
+        with self.topology_changed:
+            self.topology_updates.append((function, args))
+            self.topology_changed.notify()
+
+    def request_resync(self, node: DataNode) -> None:
+        """ Queue a full snapshot for a router, sent without waiting for the debounce window. """
+        with self.topology_changed:
+            self.topology_resyncs.add(node.name)
+            self.topology_changed.notify()
+
+    def apply_topology_changes(self) -> None:
+        while self.running.is_set():
+            self.apply_updates()
+
+            with self.topology_changed:
+                if self.topology_updates or self.link_samples:
+                    continue
+                if not self.topology_resyncs:
+                    if not self.topology_pending:
+                        self.topology_changed.wait(HEARTBEAT_CHECK_MAX)
+                        continue
+
+                    # Debounce: wait for a quiet window, bounded by the max delay since the first change
+                    deadline = min(self.topology_last + self.topology_window,
+                                   self.topology_first + self.topology_max_delay)
+                    remaining = deadline - time.time()
+                    if remaining > 0:
+                        self.topology_changed.wait(remaining)
+                        continue
+                self.topology_pending = False
+                resyncs, self.topology_resyncs = self.topology_resyncs, set()
+
+            if self.running.is_set():
+                self.push_routes(resyncs=resyncs)
+
+    def apply_updates(self) -> None:
+        """ Apply the queued changes and RTTs to the network. """
+        with self.topology_lock:
+            # Taken with the topology lock held, so batches are applied in the order they were queued
+            with self.topology_changed:
+                updates, self.topology_updates = self.topology_updates, []
+                samples, self.link_samples = self.link_samples, []
+
+            # Samples only count as a change when they move a weight
+            changed: bool = bool(updates)
+            for function, args in updates:
+                try:
+                    function(*args)
+                except Exception as ex:
+                    debug_exception(self.NAME,
+                                    f"Failed to apply a topology change: {ex}")
+            for name, rtts in samples:
+                changed = self.reweight_links(name, rtts) or changed
+        if changed:
+            self.schedule_routes()
+
+    def push_routes(self, full: bool = False, resyncs: Set[str] = frozenset()) -> None:
+        """ One recompute for all pending changes, then every new table is written concurrently. """
+        # Pushes are serialized, so an older table can never overtake a newer one
+        with self.send_lock:
+            with self.topology_lock:
+                changed = self.network.pop_changed()
+                known = self.network.get_all_nodes()
+                with self.lock:
+                    # Routers whose join is still queued get their snapshot once it is applied
+                    nodes: List[DataNode] = [node for node in self.clients if node.name in known and
+                                             (full or node.name in changed or node.name in resyncs)]
+                updates = [(node, self.network.get_routes_for(node.name), self.network.neighbours_of(node.name),
+                            node.name in resyncs)
+                           for node in nodes]
+
+            if len(updates) == 1:
+                self.send_update(*updates[0])
+            elif updates:
+                try:
+                    list(self.route_senders.map(lambda update: self.send_update(*update), updates))
+                except RuntimeError:
+                    # The senders are shut down with the interpreter while the server threads keep serving
+                    for update in updates:
+                        self.send_update(*update)
+
+    def send_update(self, node: DataNode, routes: NodeRoutes, neighbours: List[DataNode],
+                    snapshot: bool = False) -> None:
+        self.send_table(node, routes, snapshot)
+        self.send_neighbours(node, neighbours)
+
+    def send_neighbours(self, node: DataNode, neighbours: List[DataNode]) -> None:
+        # The routers to probe, only sent when they change
+        listed: Tuple = tuple(sorted((neighbour.name, neighbour.ip, neighbour.port) for neighbour in neighbours))
+        if self.sent_neighbours.get(node.name) == listed:
+            return
         try:
-            routes: NodeRoutes = self.network.get_routes_for(node.name)
-            routes_json: str = json.dumps(routes.__dict__())
-            client: socket.socket = self.clients[node]
-            client.sendall(routes_json.encode('utf-8'))
+            self.send_to(node, encode_json({"type": "neighbours", "neighbours": [list(entry) for entry in listed]}))
+            self.sent_neighbours[node.name] = listed
+        except Exception as ex:
+            debug_exception(self.NAME,
+                            f"Failed to send neighbours to {node.name}: {ex}")
+
+    def send_table(self, node: DataNode, routes: NodeRoutes, snapshot: bool = False) -> None:
+        # Called with the send lock held, each router appears once per push
+        try:
+            table: Dict[str, Tuple] = {route.destination.name: self.route_signature(route) for route in routes.routes}
+
+            previous: Dict[str, Tuple] = self.sent_routes.get(node.name)
+            epoch: int = self.route_epochs.get(node.name, 0) + 1
+
+            if snapshot or previous is None:
+                message = {
+                    "type": "routes",
+                    "epoch": epoch,
+                    "routes": routes.compact()
+                }
+            else:
+                directory: NodeDirectory = NodeDirectory()
+                upsert = [route.compact(directory) for route in routes.routes
+                          if previous.get(route.destination.name) != table[route.destination.name]]
+                remove = [name for name in previous if name not in table]
+                if not upsert and not remove:
+                    return
+                message = {
+                    "type": "routes_delta",
+                    "epoch": epoch,
+                    "base": epoch - 1,
+                    "nodes": directory.__dict__(),
+                    "upsert": upsert,
+                    "remove": remove
+                }
+
+            self.send_to(node, encode_json(message))
+
+            self.sent_routes[node.name] = table
+            self.route_epochs[node.name] = epoch
         except Exception as ex:
             debug_exception(self.NAME,
                             f"Failed to send routes to {node.name}: {ex}")
 
+    def send_to(self, node: DataNode, data: bytes) -> None:
+        self.clients[node].sendall(data)
+
+    @staticmethod
+    def route_signature(route: DataRoute) -> Tuple:
+        # Everything a router sees of a route, as cheap-to-compare tuples
+        return tuple((node.name, node.ip, node.port, node.public_key) for node in [route.destination, *route.paths]) + \
+            tuple(tuple(node.name for node in path) for path in route.alternatives) + tuple(route.costs)
+
     def update_routes(self):
-        for node in self.clients.keys():
-            self.send_routes(node)
+        # Full push, with the queued changes applied first
+        self.apply_updates()
+        self.push_routes(full=True)
+
+    def get_routes_all(self) -> List[NodeRoutes]:
+        """ Routes of every router, with the queued changes applied. """
+        self.apply_updates()
+        with self.topology_lock:
+            return self.network.get_routes_all()
 
     def close_client(self, client: socket.socket, node: DataNode) -> None:
         with self.lock:
-            if client in self.clients.values():
+            closed: bool = self.clients.get(node) is client
+            if closed:
+                try:
+                    # Wakes up the reader of a router that went silent
+                    client.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
                 client.close()
                 del self.clients[node]
-                del self.last_ping_times[node.name]
-                self.close_node(node)
-            debug_warning(self.NAME,
-                          f"Connection closed with {node.name}")
+                if self.nodes.get(node.name) is node:
+                    del self.nodes[node.name]
+                self.sent_routes.pop(node.name, None)
+                self.route_epochs.pop(node.name, None)
+                self.sent_neighbours.pop(node.name, None)
+
+        # The node is removed and routes recomputed by the scheduler
+        if closed:
+            self.liveness.remove(node.name)
+            self.change_topology(self.latency.remove, node.name)
+            self.close_node(node)
+        debug_warning(self.NAME,
+                      f"Connection closed with {node.name}")
 
     def remove_client_by_name(self, node_name: str) -> None:
         with self.lock:
-            for node, client in list(self.clients.items()):
-                if node.name == node_name:
-                    self.close_client(client, node)
-                    break
+            node: Optional[DataNode] = self.nodes.get(node_name)
+            client: Optional[socket.socket] = self.clients.get(node) if node else None
+        if client is not None:
+            self.close_client(client, node)
 
     def add_node(self, node: DataNode) -> None:
-        self.network.add_node(node)
+        self.change_topology(self.network.add_node, node)
 
     def close_node(self, node: DataNode) -> None:
-        self.network.remove_node(node)
-        self.update_routes()
+        self.change_topology(self.network.remove_node, node)
 
     def add_edge(self, u, v, w):
-        self.network.add_edge(u, v, w)
+        self.change_topology(self.network.add_edge, u, v, w)
 
     def add_all_edges(self, edges):
         for (u, v, w) in edges:
-            self.network.add_edge(u, v, w)
+            self.change_topology(self.network.add_edge, u, v, w)
 
     def stop(self) -> None:
         self.running.clear()
+        self.route_senders.shutdown(wait=False)
         self.server_socket.close()
         with self.lock:
             for client in self.clients.values():
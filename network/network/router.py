@@ -1,17 +1,40 @@
+import io
+import itertools
 import os
 import base64
 import json
 import socket
 import threading
 import time
-from typing import Dict, Tuple
-
-from network.common.data import DataNode, DataRoute, NodeRoutes, store_route, DataMessage, read_route_for, ROOT_DIR
-from network.common.security import generate_symmetric_key, encrypt_message, generate_keys, serialize_key_public, \
-    encrypt_symmetric_key, decrypt_symmetric_key, decrypt_message, encrypt_file, decrypt_file
+from collections import OrderedDict
+from typing import BinaryIO, Dict, List, Set, Tuple, Optional, Union
+
+from network.common.delivery import ClientOutbox, CLIENT_QUEUE_SIZE, DROP
+from network.common.pool import ConnectionPool, COALESCE_BYTES
+from network.common.transfer import IncomingTransfer, CHUNK_SIZE, store_file
+from network.common.framing import FrameDecoder, FrameRelay, FRAME_JSON, FRAME_DATA, FRAME_PROBE, FRAME_FORWARD, \
+    FORWARD, HEADER_SIZE, MIN_RECV_SIZE, encode_json, encode_data, encode_forward, encode_forward_header, decode_data, \
+    encode_frame, encode_ping, load_json
+from network.common.data import DataNode, DataRoute, NodeRoutes, NodeDirectory, DataMessage, ROOT_DIR, node_id, \
+    flow_id
+from network.common.keys import Identity
+from network.common.persistence import RouteStore
+from network.common.probe import LinkProber, PROBE_INTERVAL
+from network.common.security import encrypt_message, serialize_key_public, decrypt_message, encrypt_file, \
+    chunk_associated_data
+from network.common.session import SessionKeys
+from network.common.workers import WorkerPool, QUEUE_SIZE, PROCESS_THRESHOLD, MAX_INFLIGHT_BYTES
 from network.common.utils import debug_log, debug_warning, debug_exception
 
 BUFFER_SIZE = 1024 * 1024
+COMPLETED_TRANSFERS = 1024
+HEARTBEAT_INTERVAL = 1.0
+
+# Hops a forwarded message may take before it is dropped, so a transient loop cannot keep it alive
+FORWARD_TTL = 32
+
+# Forwarded frames from this size on are relayed to the next hop while they are still arriving (0 disables it)
+CUT_THROUGH_BYTES = 64 * 1024
 
 
 class Router:
@@ -20,7 +43,25 @@ class Router:
                  controller_port: int,
                  local_host: str,
                  local_port: int,
-                 name: str = "NONE"
+                 name: str = "NONE",
+                 persist_routes: bool = True,
+                 chunk_size: int = CHUNK_SIZE,
+                 key_dir: Optional[str] = None,
+                 identity: Optional[Identity] = None,
+                 coalesce_window: float = 0.0,
+                 coalesce_bytes: int = COALESCE_BYTES,
+                 workers: int = 0,
+                 queue_size: int = QUEUE_SIZE,
+                 process_workers: int = 0,
+                 process_threshold: int = PROCESS_THRESHOLD,
+                 max_inflight_bytes: int = MAX_INFLIGHT_BYTES,
+                 client_queue_size: int = CLIENT_QUEUE_SIZE,
+                 client_overflow: str = DROP,
+                 heartbeat_interval: float = HEARTBEAT_INTERVAL,
+                 probe_interval: float = PROBE_INTERVAL,
+                 source_routing: bool = False,
+                 forward_ttl: int = FORWARD_TTL,
+                 cut_through_bytes: int = CUT_THROUGH_BYTES
                  ) -> None:
         # Name
         self.NAME = f"Router | {name}"
@@ -36,15 +77,76 @@ class Router:
         self.controller_socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.clients: Dict[Tuple[str, int], socket.socket] = {}
-
-        # Security Keys
-        self.private_key, self.public_key = generate_keys()
+        self.peers: Dict[Tuple[str, int], socket.socket] = {}
+
+        # Deliveries to each local client go through its own queue and writer
+        self.outboxes: Dict[Tuple[str, int], ClientOutbox] = {}
+        self.client_queue_size: int = client_queue_size
+        self.client_overflow: str = client_overflow
+        self.framed_clients: Set[Tuple[str, int]] = set()
+
+        # Long-lived connections to the next hops, announced with a hello frame. With a coalesce_window,
+        # messages to the same next hop within that many seconds are written together
+        self.pool: ConnectionPool = ConnectionPool(self.NAME,
+                                                   hello=encode_json({"type": "hello", "name": name}),
+                                                   coalesce_window=coalesce_window,
+                                                   coalesce_bytes=coalesce_bytes)
+
+        # Routing table indexed by destination name, replaced as a whole on every update
+        self.routes: Dict[str, DataRoute] = {}
+        self.routes_node: DataNode = NodeRoutes.default().node
+        self.routes_epoch: Optional[int] = None
+        self.resync_pending: bool = False
+        self.persist_routes: bool = persist_routes
+
+        # Messages carry their destination's id and every router on the way looks it up in its next-hop
+        # table, built from its routes. With source_routing they carry the whole path instead
+        self.source_routing: bool = source_routing
+        self.forward_ttl: int = forward_ttl
+        self.cut_through_bytes: int = cut_through_bytes
+        self.node_id: int = node_id(name)
+        self.next_hops: Dict[int, DataNode] = {}
+        self.destination_ids: Dict[str, int] = {}
+        self.sequence = itertools.count()
+
+        # Stored in the background, and the last stored table is used until the controller sends one
+        self.route_store: Optional[RouteStore] = RouteStore(name) if persist_routes else None
+        if self.route_store is not None:
+            self.warm_start()
+
+        # Pings to the controller, which takes a few missed ones as a failure, carrying the RTTs measured to
+        # the neighbours the controller listed
+        self.heartbeat_interval: float = heartbeat_interval
+        self.prober: LinkProber = LinkProber(self.NAME,
+                                             hello=encode_json({"type": "hello", "name": name}),
+                                             interval=probe_interval)
+
+        # Files larger than chunk_size are streamed as separately sealed chunks (0 disables it)
+        self.chunk_size: int = chunk_size
+        self.transfers: Dict[str, IncomingTransfer] = {}
+        self.completed_transfers: OrderedDict = OrderedDict()
+
+        # Stage running the received messages, inline on the readers unless workers are set
+        self.workers: WorkerPool = WorkerPool(self.NAME, workers, queue_size, process_workers, process_threshold,
+                                              max_inflight_bytes)
+
+        # Security Keys, loaded from key_dir or generated in the background unless given, and the session keys
+        self.identity: Identity = identity or Identity.in_background(key_dir, name)
+        self.sessions: SessionKeys = SessionKeys(self.identity)
 
         # Threading Lock and Events
         self.lock = threading.Lock()
         self.running = threading.Event()
         self.running.set()
 
+    @property
+    def private_key(self):
+        return self.identity.private_key
+
+    @property
+    def public_key(self):
+        return self.identity.public_key
+
     def connect_to_controller(self) -> None:
         try:
             self.controller_socket.connect((self.controller_host, self.controller_port))
@@ -59,8 +161,7 @@ class Router:
                 port=self.local_port,
                 public_key=public_key
             )
-            json_message = json.dumps(message_auth.__dict__())
-            self.controller_socket.sendall(json_message.encode('utf-8'))
+            self.controller_socket.sendall(encode_json(message_auth.__dict__()))
 
             routes_thread = threading.Thread(target=self.routes_checker)
             heartbeat_thread = threading.Thread(target=self.send_heartbeat)
@@ -73,89 +174,300 @@ class Router:
                             f"Failed to connect to controller: {ex}")
 
     def send_heartbeat(self):
+        # A ping is a bare frame carrying the interval, so the controller knows when to expect the next
         while self.running.is_set():
             try:
-                heartbeat_message = {
-                    "type": "ping",
-                    "name": self.name
-                }
-                heartbeat_json = json.dumps(heartbeat_message)
-                self.controller_socket.sendall(heartbeat_json.encode('utf-8'))
+                self.controller_socket.sendall(encode_ping(self.heartbeat_interval, self.prober.take()))
             except Exception as ex:
                 debug_exception(self.NAME, f"Error sending heartbeat: {ex}")
-            time.sleep(5)  # Send a ping every 5 seconds
+            time.sleep(self.heartbeat_interval)
+
+    def send_controller(self, message: Dict) -> None:
+        self.controller_socket.sendall(encode_json(message))
 
     def routes_checker(self):
-        buffer = ""
+        decoder = FrameDecoder(BUFFER_SIZE)
 
         while self.running.is_set():
             try:
-                data = self.controller_socket.recv(BUFFER_SIZE)
-                if data:
+                if not decoder.recv_into(self.controller_socket):
+                    debug_warning(self.NAME,
+                                  "Connection closed by the controller")
+                    break
+
+                for frame_type, payload in decoder.frames():
                     try:
-                        buffer += data.decode('utf-8')
-
-                        # Intenta cargar el JSON completo
-                        while buffer:
-                            try:
-                                routes_json = json.loads(buffer)
-                                store_route(self.name, NodeRoutes.from_json(routes_json))
-                                buffer = ""  # Limpia el buffer si se procesa correctamente
-                            except json.JSONDecodeError as json_err:
-                                if "Unterminated string" in str(json_err):
-                                    # Es probable que se deba a datos incompletos, espera más datos
-                                    break
-                                else:
-                                    # Error inesperado de JSON, limpiamos el buffer para evitar un bucle infinito
-                                    buffer = ""
-                                    debug_warning(self.NAME, f"Received invalid JSON. Error: {json_err}")
-                            except Exception as ex:
-                                debug_warning(self.NAME, f"Received empty route update.\nError: {ex}")
-                    except UnicodeDecodeError as uni_err:
-                        debug_warning(self.NAME, f"Failed to decode UTF-8. Error: {uni_err}")
+                        self.process_routes(load_json(payload))
+                    except Exception as ex:
+                        debug_warning(self.NAME, f"Received invalid route update.\nError: {ex}")
+            except UnicodeDecodeError as uni_err:
+                debug_warning(self.NAME, f"Failed to decode UTF-8. Error: {uni_err}")
             except Exception as ex:
-                debug_exception(self.NAME, f"Error processing received routes: {ex}")
+                if self.running.is_set():
+                    debug_exception(self.NAME, f"Error processing received routes: {ex}")
+                break
+
+    def process_routes(self, routes_json: Dict) -> None:
+        message_type = routes_json.get("type")
+        if message_type == "routes":
+            self.set_routes(NodeRoutes.from_json(routes_json["routes"]), routes_json["epoch"])
+
+        elif message_type == "neighbours":
+            self.prober.set_neighbours({name: (ip, port) for name, ip, port in routes_json["neighbours"]})
 
-    def send_message(self, destination: str, message: str, is_file: bool = False, filedata: bytes = None):
-        # Find route to destination
-        route: DataRoute = read_route_for(self.name, destination)
+        elif message_type == "routes_delta":
+            # A delta only applies on top of the epoch it was computed from
+            if routes_json.get("base") != self.routes_epoch:
+                debug_warning(self.NAME,
+                              f"Route update gap: have epoch {self.routes_epoch}, got {routes_json.get('epoch')}")
+                self.request_resync()
+                return
+            self.apply_routes_delta(routes_json)
+
+        else:
+            # Plain NodeRoutes table without versioning
+            self.set_routes(NodeRoutes.from_json(routes_json))
+
+    def request_resync(self) -> None:
+        if self.resync_pending:
+            return
+        self.resync_pending = True
+        try:
+            resync_message = {
+                "type": "resync",
+                "name": self.name,
+                "epoch": self.routes_epoch
+            }
+            self.send_controller(resync_message)
+        except Exception as ex:
+            self.resync_pending = False
+            debug_exception(self.NAME, f"Error requesting route resync: {ex}")
+
+    def set_routes(self, node_routes: NodeRoutes, epoch: int = None) -> None:
+        # Build the new table aside and swap it in, so lookups never see a partial update
+        routes: Dict[str, DataRoute] = {route.destination.name: route for route in node_routes.routes}
+        self.routes_node = node_routes.node
+        self.set_table(routes)
+        self.routes_epoch = epoch
+        self.resync_pending = False
+
+        if self.route_store is not None:
+            self.route_store.save(node_routes, epoch)
+
+    def warm_start(self) -> None:
+        stored = self.route_store.load()
+        if stored is None:
+            return
+        node_routes, epoch = stored
+        self.routes_node = node_routes.node
+        self.set_table({route.destination.name: route for route in node_routes.routes})
+        # No epoch, so the controller's first delta asks for a fresh snapshot instead of applying to this
+        self.routes_epoch = None
+        debug_log(self.NAME,
+                  f"Loaded {len(self.routes)} stored routes from epoch {epoch}")
+
+    def apply_routes_delta(self, delta: Dict) -> None:
+        directory: Optional[NodeDirectory] = NodeDirectory.from_json(delta["nodes"]) if "nodes" in delta else None
+
+        routes: Dict[str, DataRoute] = dict(self.routes)
+        for destination in delta.get("remove", []):
+            routes.pop(destination, None)
+        for route_json in delta.get("upsert", []):
+            route: DataRoute = DataRoute.from_json(route_json, directory)
+            routes[route.destination.name] = route
+
+        self.set_table(routes)
+        self.routes_epoch = delta["epoch"]
+
+        if self.route_store is not None:
+            self.route_store.save(NodeRoutes(self.routes_node, list(routes.values())), self.routes_epoch)
+
+    def set_table(self, routes: Dict[str, DataRoute]) -> None:
+        # Transit traffic always takes the shortest path, only the source spreads flows over alternatives,
+        # whose continuation is the first hop's shortest path
+        next_hops: Dict[int, DataNode] = {}
+        destination_ids: Dict[str, int] = {}
+        seen: Dict[int, str] = {self.node_id: self.name}
+        for name, route in routes.items():
+            destination_id: int = node_id(name)
+            if seen.setdefault(destination_id, name) != name:
+                # Dropped on both sides, so every router agrees, and messages to them carry the path
+                debug_warning(self.NAME,
+                              f"Destination id of {name} collides with {seen[destination_id]}")
+                next_hops.pop(destination_id, None)
+                destination_ids.pop(seen[destination_id], None)
+                continue
+            if len(route.paths) > 1:
+                next_hops[destination_id] = route.paths[1]
+                destination_ids[name] = destination_id
+        self.routes = routes
+        self.next_hops = next_hops
+        self.destination_ids = destination_ids
+
+    def get_route(self, destination: str) -> Optional[DataRoute]:
+        return self.routes.get(destination)
+
+    def send_message(self, destination: str, message: str, is_file: bool = False, filedata: bytes = None,
+                     flow: str = None):
+        # Find route to destination, messages of one flow stay on one of its paths
+        route: DataRoute = self.get_route(destination)
         if not route:
             debug_warning(self.NAME,
                           f"No route found to {destination}")
             return
 
-        # Read and encode the file if it's a file
-        binary: bytes = bytes()
-        if is_file and filedata:
-            binary = base64.b64encode(filedata)
-
-        # Generate symmetric key and encrypt message
-        sym_key = generate_symmetric_key()
-        encrypted_message = encrypt_message(message, sym_key)
-
-        # Encrypt the binary data if it's a file
-        encrypted_binary = encrypt_file(binary, sym_key) if is_file else ""
+        # Large files go out as a stream of chunks
+        if is_file and filedata and self.chunk_size and len(filedata) > self.chunk_size:
+            self.send_file(destination, message, io.BytesIO(filedata))
+            return
 
         # Get public key of last router and store next_node
-        next_node: DataNode = route.paths[1]
-        last_node: DataNode = route.paths[-1]
+        path: List[DataNode] = route.path_for(flow)
+        next_node: DataNode = path[1]
+        last_node: DataNode = path[-1]
         last_router_public_key: str = last_node.public_key
 
         if not last_router_public_key:
             debug_warning(self.NAME,
                           f"Last Router Public Key is empty for node {last_node.name}")
 
-        encrypted_sym_key = encrypt_symmetric_key(sym_key, last_router_public_key)
+        # Session key for the last router and encrypt message
+        session = self.sessions.for_destination(last_node.name, last_router_public_key)
+        encrypted_message = encrypt_message(message, session.aead)
+
+        # Encrypt the raw binary data if it's a file
+        encrypted_binary = encrypt_file(filedata or b"", session.aead) if is_file else b""
 
-        # Send encrypted message and encrypted symmetric key to next router
+        # Send encrypted message, wrapped session key and its id to next router
         data_message = DataMessage(
             message=encrypted_message,
-            path=route.paths[1:],  # Remaining path
-            key=encrypted_sym_key,
+            path=path[1:],  # Remaining path
+            key=session.wrapped_key,
             is_file=is_file,
-            binary=encrypted_binary
+            binary=encrypted_binary,
+            key_id=session.key_id
+        )
+        self.send_message_client(data_message, next_node, flow)
+
+    def send_file(self, destination: str, name: str, stream: BinaryIO, chunk_size: int = None) -> Optional[str]:
+        """ Stream a file to destination in separately sealed chunks, returns the transfer id. """
+        chunk_size = chunk_size or self.chunk_size or CHUNK_SIZE
+
+        route: DataRoute = self.get_route(destination)
+        if not route or len(route.paths) < 2:
+            debug_warning(self.NAME,
+                          f"No route found to {destination}")
+            return None
+
+        transfer_id: str = os.urandom(8).hex()
+        path: List[DataNode] = route.path_for(transfer_id)
+
+        chunk: int = 0
+        offset: int = 0
+        data: bytes = stream.read(chunk_size)
+        while True:
+            # Read one chunk ahead to know which one is the last
+            next_data: bytes = stream.read(chunk_size)
+            last_chunk: bool = not next_data
+
+            self.send_chunk(path, transfer_id, name, chunk, offset, data, last_chunk)
+
+            if last_chunk:
+                break
+            chunk += 1
+            offset += len(data)
+            data = next_data
+
+        debug_log(self.NAME,
+                  f"File {name} streamed to {destination} in {chunk + 1} chunks")
+        return transfer_id
+
+    def send_chunk(self, path: List[DataNode], transfer_id: str, name: str, chunk: int, offset: int, data: bytes,
+                   last_chunk: bool) -> None:
+        # Every chunk is sealed on its own, and may move to a new session key mid transfer
+        last_node: DataNode = path[-1]
+        session = self.sessions.for_destination(last_node.name, last_node.public_key)
+        data_message = DataMessage(
+            message=encrypt_message(name, session.aead),
+            path=path[1:],
+            key=session.wrapped_key,
+            is_file=True,
+            binary=encrypt_file(data, session.aead, chunk_associated_data(transfer_id, chunk, offset, last_chunk)),
+            transfer_id=transfer_id,
+            chunk=chunk,
+            offset=offset,
+            last_chunk=last_chunk,
+            key_id=session.key_id
         )
-        self.send_message_client(data_message, next_node)
+        self.send_message_client(data_message, path[1], transfer_id)
+
+    def forward_upload(self, destination: str, name: str, upload_id: str, chunk: int, offset: int, data: bytes,
+                       last_chunk: bool) -> None:
+        # A client streaming a file sends it chunk by chunk, each one is sealed and sent on as it comes
+        route: DataRoute = self.get_route(destination)
+        if not route or len(route.paths) < 2:
+            debug_warning(self.NAME,
+                          f"No route found to {destination}")
+            return
+        # The whole upload is one flow
+        self.send_chunk(route.path_for(upload_id), upload_id, name, chunk, offset, data, last_chunk)
+        if last_chunk:
+            debug_log(self.NAME,
+                      f"File {name} streamed to {destination} in {chunk + 1} chunks")
+
+    def receive_chunk(self, data_message: DataMessage) -> None:
+        transfer_id: str = data_message.transfer_id
+        with self.lock:
+            transfer: IncomingTransfer = self.transfers.get(transfer_id)
+            if transfer is None and transfer_id in self.completed_transfers:
+                return
+
+        sym_key, aead = self.sessions.key_for_message(data_message.key_id, data_message.key)
+        if transfer is None:
+            name = decrypt_message(data_message.message, aead)
+            file_path = os.path.join(ROOT_DIR, "received", self.name, f"received_file_{name}")
+
+            with self.lock:
+                transfer = self.transfers.get(transfer_id)
+                if transfer is None:
+                    self.drop_stale_transfers()
+                    transfer = IncomingTransfer(transfer_id, name, file_path)
+                    self.transfers[transfer_id] = transfer
+
+        associated_data = chunk_associated_data(transfer_id, data_message.chunk, data_message.offset,
+                                                data_message.last_chunk)
+        data: bytes = self.workers.decrypt(data_message.binary, sym_key, aead, associated_data)
+        if not transfer.write(data_message.chunk, data_message.offset, data, data_message.last_chunk):
+            return
+
+        with self.lock:
+            self.transfers.pop(transfer_id, None)
+            self.completed_transfers[transfer_id] = True
+            if len(self.completed_transfers) > COMPLETED_TRANSFERS:
+                self.completed_transfers.popitem(last=False)
+        transfer.finish()
+
+        debug_log(self.NAME,
+                  f"File saved as {transfer.file_path}")
+        self.deliver_to_clients(transfer.name)
+
+    def discard_transfers(self) -> None:
+        # Incomplete transfers leave no partial files behind
+        with self.lock:
+            transfers = list(self.transfers.values())
+            self.transfers.clear()
+        for transfer in transfers:
+            transfer.discard()
+
+    def drop_stale_transfers(self) -> None:
+        # Called with the lock held
+        now = time.time()
+        for transfer_id, transfer in list(self.transfers.items()):
+            if transfer.is_stale(now):
+                debug_warning(self.NAME,
+                              f"Dropping incomplete transfer {transfer_id} of {transfer.name}")
+                transfer.discard()
+                del self.transfers[transfer_id]
 
     def start_server(self) -> None:
         try:
@@ -190,34 +502,87 @@ class Router:
                                     f"Error accepting clients: {ex}")
 
     def read_messages(self, client_socket: socket.socket, address: Tuple[str, int]):
+        # Payload bytes reserved for the frame being received, which is the next one out of the decoder
+        reserved: int = 0
         try:
-            buffer = ""
+            decoder = FrameDecoder(BUFFER_SIZE)
             while self.running.is_set():
-                data: bytes = client_socket.recv(BUFFER_SIZE)
-                if not data:
+                # A frame that may still be cut through is neither reserved nor buffered whole meanwhile
+                relayable: bool = self.may_cut_through(decoder)
+                if not reserved and not relayable:
+                    reserved = self.admit_frame(decoder)
+                if not decoder.recv_into(client_socket, MIN_RECV_SIZE if relayable else None):
                     debug_log(self.NAME,
                               f"Connection closed by {address}")
                     break
 
-                buffer += data.decode('utf-8')
+                for frame_type, payload in decoder.frames():
+                    self.workers.submit(self.process_frame, frame_type, payload, client_socket, address,
+                                        size=len(payload) if frame_type in (FRAME_DATA, FRAME_FORWARD) else 0,
+                                        reserved=bool(reserved))
+                    reserved = 0
 
-                while True:
-                    try:
-                        # Try to parse the buffer as a JSON message
-                        message_json, end_index = json.JSONDecoder().raw_decode(buffer)
-                        buffer = buffer[end_index:].lstrip()
-                        self.process_message(message_json)
-                    except json.JSONDecodeError:
-                        # Not enough data to decode a full message
-                        break
+                if self.cut_through_bytes and self.cut_through(decoder, client_socket):
+                    # Relayed without being buffered
+                    self.workers.release(reserved)
+                    reserved = 0
 
         except Exception as ex:
             if self.running.is_set():
                 debug_exception(self.NAME,
                                 f"Error Reading Messages: {ex}")
         finally:
+            self.workers.release(reserved)
             self.close_client(client_socket, address)
 
+    def admit_frame(self, decoder: FrameDecoder) -> int:
+        """
+        Reserve the payload of the data frame the decoder is in the middle of, before the rest of it is
+        received, so the in-flight cap holds for frames of any size. Returns the bytes reserved.
+        """
+        frame = decoder.pending_frame()
+        if frame is None or frame[0] not in (FRAME_DATA, FRAME_FORWARD):
+            return 0
+        self.workers.reserve(frame[1])
+        return frame[1]
+
+    def process_frame(self, frame_type: int, payload: Union[bytes, Dict], client: socket.socket,
+                      address: Tuple[str, int]) -> None:
+        # Clients that frame their messages get their deliveries framed too
+        if not isinstance(payload, dict) and address in self.clients and address not in self.framed_clients:
+            self.framed_clients.add(address)
+
+        if frame_type == FRAME_PROBE:
+            # A neighbour measuring the round trip, answered on its own connection
+            client.sendall(encode_frame(payload, FRAME_PROBE))
+            return
+
+        if frame_type == FRAME_FORWARD:
+            # Only the fixed header is read here, unless this router is the destination
+            self.forward_frame(payload)
+            return
+
+        if frame_type == FRAME_DATA:
+            # Header and raw binary body
+            message_json, binary = decode_data(payload)
+            message_json['binary'] = binary
+            self.process_message(message_json)
+            return
+
+        if frame_type != FRAME_JSON:
+            debug_warning(self.NAME,
+                          f"Unknown frame type {frame_type} from {address}")
+            return
+
+        message_json: Dict = load_json(payload)
+        if message_json.get("type") == "hello":
+            self.register_peer(client, address, message_json.get("name"))
+            return
+        if message_json.get("type") == "client":
+            # Announces a framing client, already noted above
+            return
+        self.process_message(message_json)
+
     def process_message(self, message_json: Dict):
 
         if not DataMessage.is_message(message_json):
@@ -228,20 +593,36 @@ class Router:
             client_is_file = message_json.get('is_file', False)
             client_binary_encoded = message_json.get('binary', "")
 
-            if client_is_file:
+            if client_is_file and isinstance(client_binary_encoded, str):
+                # Plain JSON clients send the file base64 encoded
                 try:
                     client_binary = base64.b64decode(client_binary_encoded)
                 except Exception as e:
                     print(f"Failed to decode binary data: {e}")
                     return
+            elif client_is_file:
+                client_binary = client_binary_encoded
             else:
                 client_binary = bytes()
 
+            if message_json.get('upload_id'):
+                self.forward_upload(
+                    destination=client_destination,
+                    name=client_message,
+                    upload_id=message_json['upload_id'],
+                    chunk=message_json.get('chunk', 0),
+                    offset=message_json.get('offset', 0),
+                    data=client_binary,
+                    last_chunk=message_json.get('last_chunk', False)
+                )
+                return
+
             self.send_message(
                 destination=client_destination,
                 message=client_message,
                 is_file=client_is_file,
-                filedata=client_binary
+                filedata=client_binary,
+                flow=message_json.get('flow')
             )
             return
 
@@ -261,32 +642,7 @@ class Router:
 
         # Check if this router is the final destination
         if data_message.is_destine(self.name):
-            enc_message = data_message.message
-            enc_sym_key = data_message.key
-
-            sym_key = decrypt_symmetric_key(enc_sym_key, self.private_key)
-            message = decrypt_message(enc_message, sym_key)
-            debug_log(self.NAME,
-                      f"Decrypted message: {message}")
-
-            # Handle file message if it is a file
-            if data_message.is_file:
-                enc_binary = data_message.binary
-                binary = decrypt_file(enc_binary, sym_key)
-                decoded_message = base64.b64decode(binary)
-                file_path = os.path.join(ROOT_DIR, "received", self.name, f"received_file_{message}")
-                os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                with open(file_path, 'wb') as file:
-                    file.write(decoded_message)
-                    debug_log(self.NAME,
-                              f"File saved as {file_path}")
-
-            for client in self.clients.values():
-                message_to_client = {
-                    'message': message
-                }
-                message_json = json.dumps(message_to_client)
-                client.sendall(message_json.encode('utf-8'))
+            self.receive_data(data_message)
 
         else:
             # Get the next node before popping the current node
@@ -301,23 +657,164 @@ class Router:
 
             self.send_message_client(data_message, next_node)
 
+    def receive_data(self, data_message: DataMessage) -> None:
+        if data_message.transfer_id:
+            self.receive_chunk(data_message)
+            return
+
+        enc_message = data_message.message
+        enc_sym_key = data_message.key
+
+        sym_key, aead = self.sessions.key_for_message(data_message.key_id, enc_sym_key)
+        message = decrypt_message(enc_message, aead)
+        debug_log(self.NAME,
+                  f"Decrypted message: {message}")
+
+        # Handle file message if it is a file
+        if data_message.is_file:
+            enc_binary = data_message.binary
+            binary = self.workers.decrypt(enc_binary, sym_key, aead)
+            file_path = os.path.join(ROOT_DIR, "received", self.name, f"received_file_{message}")
+            store_file(file_path, binary)
+            debug_log(self.NAME,
+                      f"File saved as {file_path}")
+
+        self.deliver_to_clients(message)
+
+    def deliver_to_clients(self, message: str) -> None:
+        message_to_client = {
+            'message': message
+        }
+        message_json = json.dumps(message_to_client).encode('utf-8')
+        message_frame = encode_json(message_to_client)
+
+        # Outboxes are opened on the first delivery, peers never get one
+        with self.lock:
+            deliveries = []
+            for address, client in self.clients.items():
+                outbox = self.outboxes.get(address)
+                if outbox is None:
+                    outbox = self.open_outbox(client, address)
+                    self.outboxes[address] = outbox
+                deliveries.append((outbox, message_frame if address in self.framed_clients else message_json))
+
+        for outbox, data in deliveries:
+            outbox.put(data)
+
+    def open_outbox(self, client: socket.socket, address: Tuple[str, int]) -> ClientOutbox:
+        return ClientOutbox(self.NAME, client, address, self.close_client, self.client_queue_size,
+                            self.client_overflow)
+
+    def register_peer(self, client: socket.socket, address: Tuple[str, int], name: str) -> None:
+        # Connections from neighbour routers only carry forwarded traffic, never client deliveries
+        with self.lock:
+            self.clients.pop(address, None)
+            self.framed_clients.discard(address)
+            self.peers[address] = client
+        debug_log(self.NAME,
+                  f"Connection from {address} is router {name}")
+
     def close_client(self, client: socket.socket, address: Tuple[str, int]) -> None:
         with self.lock:
+            self.framed_clients.discard(address)
+            outbox = self.outboxes.pop(address, None)
+            if outbox is not None:
+                outbox.close()
             if client in self.clients.values():
+                try:
+                    # Wakes up a writer blocked on a slow client
+                    client.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
                 client.close()
                 del self.clients[address]
+            elif client in self.peers.values():
+                client.close()
+                del self.peers[address]
         debug_warning(self.NAME,
                       f"Connection closed with {address}")
 
-    def send_message_client(self, data_message: DataMessage, next_node: DataNode) -> None:
-        json_message = json.dumps(data_message.__dict__())
+    def send_message_client(self, data_message: DataMessage, next_node: DataNode, flow: str = None) -> None:
+        self.send_frame(next_node, self.encode_message(data_message, flow))
+
+    def encode_message(self, data_message: DataMessage, flow: str = None) -> bytes:
+        destination_id: Optional[int] = self.destination_ids.get(data_message.path[-1].name)
+        if self.source_routing or destination_id is None:
+            return encode_data(data_message.header(), data_message.binary)
+        # A fixed header with the destination instead of the path, the key exchange stays end to end
+        return encode_forward(destination_id, self.forward_ttl, flow_id(flow), next(self.sequence),
+                              data_message.header(path=False), data_message.binary)
+
+    def may_cut_through(self, decoder: FrameDecoder) -> bool:
+        """ Whether the frame in progress is large enough to relay, but its forward header is not in yet. """
+        frame = decoder.pending_frame()
+        return bool(self.cut_through_bytes) and frame is not None and frame[0] == FRAME_FORWARD and \
+            frame[1] >= self.cut_through_bytes and frame[2] < FORWARD.size
+
+    def cut_through(self, decoder: FrameDecoder, client_socket: socket.socket) -> bool:
+        """
+        Relay a large forwarded frame still arriving on client_socket to its next hop, as it arrives.
+        Transit routers only need the forward header, so the rest is never buffered whole. Returns
+        whether the frame was taken out of the decoder.
+        """
+        partial = decoder.partial()
+        if partial is None:
+            return False
+        frame_type, length, received = partial
+        if frame_type != FRAME_FORWARD or length < self.cut_through_bytes or len(received) < FORWARD.size:
+            return False
+
+        destination_id, ttl, flow, sequence = FORWARD.unpack_from(received)
+        next_node: Optional[DataNode] = self.next_hops.get(destination_id)
+        # Frames for this router, without a next hop or out of hops take the regular path
+        if destination_id == self.node_id or next_node is None or ttl <= 1:
+            return False
+
+        head: bytes = encode_forward_header(length, destination_id, ttl - 1, flow, sequence) + \
+            bytes(received[FORWARD.size:])
+        relay = FrameRelay(client_socket, head, length - len(received))
+        received.release()
+        decoder.discard_partial()
+
         try:
-            next_node_client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            next_node_client_socket.connect((next_node.ip, next_node.port))
-            next_node_client_socket.sendall(json_message.encode('utf-8'))
+            self.pool.send_stream((next_node.ip, next_node.port), relay)
             debug_log(self.NAME,
-                      f"Message SENT to {next_node.name}: {json_message[:15]}")
-            next_node_client_socket.close()
+                      f"Message RELAYED to {next_node.name}: {HEADER_SIZE + length} bytes")
+        except Exception as ex:
+            debug_exception(self.NAME,
+                            f"Failed to relay message to {next_node.name}: {ex}")
+            # What is left of the frame is still read, so the next one starts where expected
+            relay.drain()
+        return True
+
+    def forward_frame(self, payload: bytes) -> None:
+        destination_id, ttl, flow, sequence = FORWARD.unpack_from(payload)
+        if destination_id == self.node_id:
+            message_json, binary = decode_data(payload, FORWARD.size)
+            message_json['binary'] = binary
+            self.receive_data(DataMessage.from_json(message_json))
+            return
+
+        next_node: Optional[DataNode] = self.next_hops.get(destination_id)
+        if next_node is None:
+            debug_warning(self.NAME,
+                          f"No next hop for destination {destination_id:#010x}, message {sequence} dropped")
+            return
+        if ttl <= 1:
+            debug_warning(self.NAME,
+                          f"TTL expired for destination {next_node.name}, message {sequence} dropped")
+            return
+
+        # The frame is copied once, with the new TTL, and the rest of the payload is left untouched
+        self.send_frame(next_node, b"".join((encode_forward_header(len(payload), destination_id, ttl - 1, flow,
+                                                                   sequence),
+                                             memoryview(payload)[FORWARD.size:])))
+
+    def send_frame(self, next_node: DataNode, frame: bytes) -> None:
+        try:
+            self.pool.send((next_node.ip, next_node.port), frame)
+            debug_log(self.NAME,
+                      f"Message SENT to {next_node.name}: {len(frame)} bytes")
         except Exception as ex:
             debug_exception(self.NAME,
                             f"Failed to send message to {next_node.name}: {ex}")
@@ -332,8 +829,18 @@ class Router:
             debug_exception(self.NAME,
                             f"Error closing controller socket: {ex}")
 
+        self.pool.close_all()
+        self.workers.shutdown()
+        self.discard_transfers()
+        if self.route_store is not None:
+            self.route_store.close()
+        self.prober.close()
+
         with self.lock:
-            for client in self.clients.values():
+            for outbox in self.outboxes.values():
+                outbox.close()
+            self.outboxes.clear()
+            for client in [*self.clients.values(), *self.peers.values()]:
                 try:
                     client.shutdown(socket.SHUT_RDWR)
                     client.close()
@@ -341,6 +848,7 @@ class Router:
                     debug_exception(self.NAME,
                                     f"Error closing client socket: {ex}")
             self.clients.clear()
+            self.peers.clear()
 
         debug_warning(self.NAME,
                       "Router Server Stopped.")
@@ -33,9 +33,8 @@ def main():
 
     # Enviar el mensaje, con o sin archivo adjunto
     if file_path:
-        with open(file_path, 'rb') as f:
-            filedata = f.read()
-        client.send_message(destination, message, is_file=True, binary=filedata)
+        # El archivo se envía por partes, sin cargarlo entero en memoria
+        client.send_file(destination, file_path, name=message)
     else:
         client.send_message(destination, message)
 
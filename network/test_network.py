@@ -2,6 +2,7 @@ import json
 import threading
 import time
 
+from network.common.keys import KeyPool, Identity
 from network.common.networkk import Network
 from network.controller import Controller
 from network.router import Router
@@ -16,8 +17,8 @@ def create_controller(host: str, port: int, network: Network) -> Controller:
     return controller
 
 
-def create_router(name: str, host: str, port: int, controller: Controller):
-    router = Router(controller.host, controller.port, host, port, name)
+def create_router(name: str, host: str, port: int, controller: Controller, identity: Identity):
+    router = Router(controller.host, controller.port, host, port, name, identity=identity)
     router.connect_to_controller()
     routers.append(router)
 
@@ -69,6 +70,9 @@ def main():
         ("DC", "NJ", 300),
     ]
 
+    # Keypairs for every router, generated while the controller starts
+    key_pool = KeyPool(len(nodes))
+
     # Create Controller
     controller = create_controller(
         "localhost",
@@ -80,7 +84,7 @@ def main():
     print("\n\nTest: Creation of Routers and Edges")
 
     for node, (host, port) in nodes.items():
-        thread = threading.Thread(target=create_router, args=(node, host, port, controller))
+        thread = threading.Thread(target=create_router, args=(node, host, port, controller, key_pool.take()))
         threads.append(thread)
         thread.start()
         time.sleep(1)
@@ -89,8 +93,7 @@ def main():
         thread.join()
 
     # Add edges and update routes after all routers are connected
-    for (u, v, w) in edges:
-        network.add_edge(u, v, w)
+    controller.add_all_edges(edges)
 
     controller.update_routes()
 
@@ -100,7 +103,7 @@ def main():
     print("\n\nTest: Creation of routes.json from Edges and Nodes")
 
     # Store the routes
-    routes = network.get_routes_all()
+    routes = controller.get_routes_all()
     with open("routes/routes.json", "w") as f:
         json.dump([route.__dict__() for route in routes], f, indent=4)
 